@@ -0,0 +1,118 @@
+"""
+Measures the memory held by the parsed records and the peak RSS of a full-vault crawl.
+
+The record footprint is the memory allocated (tracemalloc) by `--records` copies of the
+recorded game page, held as records, as the dicts written to MongoDB and as mongoengine
+Documents. The crawl is vault_benchmark over every letter of the vault stand-in, run in
+a fresh process whose peak RSS is reported, with the parsers inline so the records never
+leave it. `--revision` also crawls the tree of another git revision, to compare with.
+
+    python -m benchmarks.memory_benchmark
+    python -m benchmarks.memory_benchmark --revision HEAD~1 --database-url mongomock
+"""
+import argparse
+import copy
+import json
+import os
+import string
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), 'fixtures')
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs a command and prints the peak RSS of the largest process it ran, in KB on Linux
+# and in bytes on macOS. A new interpreter per crawl, since the peak never goes down.
+MEASURE_RSS = ('import resource, subprocess, sys; '
+               'subprocess.run(sys.argv[1:], check=True, stdout=subprocess.DEVNULL); '
+               'print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)')
+
+
+def allocated(create, count):
+    """
+    Get the bytes still allocated by `count` objects made by `create()`.
+    """
+    tracemalloc.start()
+    objects = [create() for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def measure_records(count):
+    from src.game_data_extractor import GameDataDocument
+    from src.page_parser import parse_game_page
+
+    with open(os.path.join(FIXTURES_PATH, 'game_downloadable.html'), 'rb') as file:
+        record = parse_game_page(file.read())
+    record.URL = 'https://vimm.net/vault/1'
+
+    return {
+        'record': allocated(lambda: copy.deepcopy(record), count) / count,
+        'dict': allocated(lambda: copy.deepcopy(record.to_storage()), count) / count,
+        'document': allocated(lambda: GameDataDocument(**record.to_storage()), count) / count,
+    }
+
+
+def measure_crawl(tree, database_url):
+    """
+    Crawl the whole vault stand-in with the benchmark of `tree`, and get its peak RSS in MB.
+    """
+    environment = dict(os.environ, PARSE_WORKERS='0')
+    command = [sys.executable, '-c', MEASURE_RSS, sys.executable, '-m',
+               'benchmarks.vault_benchmark', '--letters', string.ascii_uppercase,
+               '--downloads', '0', '--database-url', database_url]
+    output = subprocess.run(command, cwd=tree, env=environment, check=True,
+                            capture_output=True, text=True).stdout
+    peak = int(output.split()[-1])
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def measure_revision(revision, database_url):
+    """
+    Crawl with the tree of a git revision, checked out in a temporary worktree.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        tree = os.path.join(directory, 'tree')
+        subprocess.run(['git', 'worktree', 'add', '--detach', tree, revision],
+                       cwd=ROOT_PATH, check=True, capture_output=True)
+        try:
+            return measure_crawl(tree, database_url)
+        finally:
+            subprocess.run(['git', 'worktree', 'remove', '--force', tree],
+                           cwd=ROOT_PATH, check=True, capture_output=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--records', type=int, default=10000,
+                        help='game records held to measure their footprint')
+    parser.add_argument('--revision',
+                        help='git revision to crawl with as well, e.g. HEAD~1')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL', 'mongomock'),
+                        help="MongoDB server to crawl into, or 'mongomock' for an in-memory database")
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    stats = {'record_bytes': measure_records(args.records),
+             'crawl_peak_rss_mb': {'working tree': measure_crawl(ROOT_PATH, args.database_url)}}
+    if args.revision:
+        stats['crawl_peak_rss_mb'][args.revision] = measure_revision(
+            args.revision, args.database_url)
+
+    if args.json:
+        print(json.dumps(stats, indent=4))
+        return 0
+
+    for kind, size in stats['record_bytes'].items():
+        print(f"Game as {kind:9} {size:8.0f} bytes")
+    for tree, peak in stats['crawl_peak_rss_mb'].items():
+        print(f"Crawl peak RSS ({tree}): {peak:.1f} MB")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Checks the page parsers against the recorded fixtures and measures their parse time.
+
+Every fixture page in benchmarks/fixtures is parsed with each available parser backend,
+the record is compared with the expected record stored next to it (<page>.json) and the
+average parse time per page is reported.
+
+    python -m benchmarks.parse_benchmark
+    python -m benchmarks.parse_benchmark --backends lxml --repeat 500
+    python -m benchmarks.parse_benchmark --record   # rewrite the expected records
+"""
+import argparse
+import dataclasses
+import glob
+import json
+import os
+import sys
+import time
+from bs4 import FeatureNotFound
+from src.page_parser import parse_console_page, parse_game_page, parse_game_links
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def parser_for(fixture):
+    """
+    Game pages are named game_*.html, console pages console_*.html and listing pages listing_*.html.
+    """
+    if os.path.basename(fixture).startswith('game_'):
+        return parse_game_page
+    if os.path.basename(fixture).startswith('console_'):
+        return parse_console_page
+    return parse_game_links
+
+
+def as_json(record):
+    """
+    Turn the records returned by a parser into the JSON stored in the fixtures.
+    """
+    if dataclasses.is_dataclass(record):
+        return dataclasses.asdict(record)
+    if isinstance(record, list):
+        return [as_json(item) for item in record]
+    if isinstance(record, dict):
+        return {key: as_json(value) for key, value in record.items()}
+    return record
+
+
+def expected_path(fixture):
+    return os.path.splitext(fixture)[0] + '.json'
+
+
+def record_fixtures(fixtures, backend):
+    for fixture in fixtures:
+        with open(fixture, 'rb') as file:
+            record = as_json(parser_for(fixture)(file.read(), backend))
+        with open(expected_path(fixture), 'w') as file:
+            json.dump(record, file, indent=4)
+            file.write('\n')
+        print(f"Recorded {os.path.basename(expected_path(fixture))}")
+
+
+def benchmark_backend(fixtures, backend, repeat):
+    """
+    Parse every fixture with the backend. Returns False if a record differs from the expected one.
+    """
+    equivalent = True
+    for fixture in fixtures:
+        parser = parser_for(fixture)
+        with open(fixture, 'rb') as file:
+            content = file.read()
+        with open(expected_path(fixture)) as file:
+            expected = json.load(file)
+
+        record = as_json(parser(content, backend))
+        if record != expected:
+            equivalent = False
+            print(f"MISMATCH {backend} {os.path.basename(fixture)}:\n"
+                  f"  expected: {expected}\n  got:      {record}")
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            parser(content, backend)
+        elapsed = (time.perf_counter() - start) / repeat
+
+        print(f"{backend:12} {os.path.basename(fixture):28} "
+              f"{len(content) / 1024:7.1f} KB {elapsed * 1000:8.3f} ms/page")
+
+    return equivalent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--backends', nargs='+', default=['html.parser', 'lxml'])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--record', action='store_true',
+                        help='rewrite the expected records with the first backend')
+    args = parser.parse_args()
+
+    fixtures = sorted(glob.glob(os.path.join(FIXTURES_PATH, 'game_*.html')) +
+                      glob.glob(os.path.join(FIXTURES_PATH, 'console_*.html')) +
+                      glob.glob(os.path.join(FIXTURES_PATH, 'listing_*.html')))
+    if args.record:
+        record_fixtures(fixtures, args.backends[0])
+        return 0
+
+    equivalent = True
+    for backend in args.backends:
+        try:
+            equivalent &= benchmark_backend(fixtures, backend, args.repeat)
+        except FeatureNotFound:
+            print(f"Parser backend {backend} is not installed, skipping.")
+
+    return 0 if equivalent else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""
+Runs the crawler and the downloader end to end against a local stand-in of the vault.
+
+A local aiohttp server serves the recorded fixture pages (the vault index, console and
+letter listings and game pages) and synthetic zip archives for the downloads. The crawl
+runs ConsoleDataExtractor and GameDataExtractor into a dedicated benchmark database,
+then GameDownloadChecker downloads the first console's downloadable games. The report
+gives pages/sec, parse ms/page, DB writes/sec and download MB/s.
+
+    python -m benchmarks.vault_benchmark
+    python -m benchmarks.vault_benchmark --letters ABCDEFGHIJKLMNOPQRSTUVWXYZ --downloads 10
+    python -m benchmarks.vault_benchmark --database-url mongomock --json
+    python -m benchmarks.vault_benchmark --storage sqlite
+
+The benchmark database (vimmlair_benchmark on the server of DATABASE_URL, or an
+in-memory mongomock database) is cleared before every run. With `--storage sqlite`
+the crawl goes to a temporary SQLite file instead.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import time
+import zipfile
+from urllib.parse import urlsplit
+from aiohttp import web
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), 'fixtures')
+BENCHMARK_DATABASE = 'vimmlair_benchmark'
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_PATH, name), encoding='utf-8') as file:
+        return file.read()
+
+
+class VaultStandIn:
+    """
+    Serves the vault from the recorded fixtures.
+
+    Every console listing page (the console page, the pages of `letters` and the '#'
+    section) is the recorded listing with its game links renumbered, so each one links to
+    its own games. The letter navigation links only those sections, and the other letter
+    pages are empty. Game pages are the recorded game pages with the console, the title
+    and the mediaId of the requested game. The first `downloads`
+    games of the first console can be downloaded, as a zip of `download_size` bytes.
+    An `error_rate` share of the requests is answered with 503 Service Unavailable.
+    """
+    PAGE_GAMES = 100
+
+    def __init__(self, letters, downloads, download_size, error_rate=0.0):
+        self.letters = letters
+        self.downloads = downloads
+        self.error_rate = error_rate
+        self.vault = read_fixture('vault.html')
+        self.listing = read_fixture('listing_letter.html')
+        self.empty_listing = read_fixture('listing_empty.html')
+        self.game = read_fixture('game_downloadable.html')
+        self.unavailable_game = read_fixture('game_unavailable.html')
+        self.consoles = re.findall(r'<a href="/vault/(\w+)">([^<]+)</a></td><td>\d{4}',
+                                   self.vault)
+        self.slugs = [slug for slug, _ in self.consoles]
+        # Games are numbered by console, then by listing page: the console page, its
+        # letters and the '#' section
+        self.console_games = (len(letters) + 2) * self.PAGE_GAMES
+        self.payload = self.create_payload(download_size)
+
+    @staticmethod
+    def create_payload(size):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_file:
+            zip_file.writestr('game.iso', os.urandom(size))
+        return archive.getvalue()
+
+    def application(self):
+        app = web.Application(middlewares=[self.inject_errors])
+        app.router.add_get('/vault', self.serve_vault)
+        app.router.add_get('/vault/', self.serve_vault)
+        app.router.add_get('/vault/{name}', self.serve_console_or_game)
+        app.router.add_get('/vault/{name}/{letter}', self.serve_listing)
+        app.router.add_get('/download/', self.serve_download)
+        return app
+
+    @web.middleware
+    async def inject_errors(self, request, handler):
+        if random.random() < self.error_rate:
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return await handler(request)
+
+    async def serve_vault(self, request):
+        if request.query.get('p') == 'list':
+            return self.listing_page(request.query.get('system'), len(self.letters) + 1)
+        return web.Response(text=self.vault, content_type='text/html')
+
+    async def serve_console_or_game(self, request):
+        name = request.match_info['name']
+        if name.isdigit():
+            return self.game_page(int(name))
+        return self.listing_page(name, 0)
+
+    async def serve_listing(self, request):
+        letter = request.match_info['letter']
+        if letter not in self.letters:
+            return web.Response(text=self.empty_listing, content_type='text/html')
+        return self.listing_page(request.match_info['name'], self.letters.index(letter) + 1)
+
+    def listing_page(self, slug, page):
+        if slug not in self.slugs:
+            raise web.HTTPNotFound()
+
+        first_id = (self.slugs.index(slug) + 1) * self.console_games + page * self.PAGE_GAMES
+        rows = iter(range(first_id, first_id + self.PAGE_GAMES))
+        body = re.sub(r'href="/vault/\d+"',
+                      lambda match: f'href="/vault/{next(rows)}"', self.listing)
+
+        navigation = [f'<a href="/vault/?p=list&amp;system={slug}&amp;section=number">#</a>']
+        navigation += [f'<a href="/vault/{slug}/{letter}">{letter}</a>' for letter in self.letters]
+        body = re.sub(r'<div class="letters">.*?</div>',
+                      '<div class="letters">\n' + '\n'.join(navigation) + '\n</div>',
+                      body, flags=re.DOTALL)
+        return web.Response(text=body, content_type='text/html')
+
+    def game_page(self, game_id):
+        console_index = game_id // self.console_games - 1
+        if not 0 <= console_index < len(self.consoles):
+            raise web.HTTPNotFound()
+
+        console_name = self.consoles[console_index][1]
+        game_number = game_id % self.console_games
+        downloadable = console_index == 0 and game_number < self.downloads
+
+        body = self.game if downloadable else self.unavailable_game
+        title = base64.b64encode(f'{console_name} Game {game_id}'.encode()).decode()
+        body = re.sub(r'<div class="sectionTitle">[^<]*</div>',
+                      f'<div class="sectionTitle">{console_name}</div>', body)
+        body = re.sub(r'data-v="[^"]*"', f'data-v="{title}"', body)
+        body = re.sub(r'name="mediaId" value="\d+"',
+                      f'name="mediaId" value="{game_id}"', body)
+        return web.Response(text=body, content_type='text/html')
+
+    async def serve_download(self, request):
+        match = re.match(r'bytes=(\d+)-', request.headers.get('Range', ''))
+        if not match:
+            return web.Response(body=self.payload, content_type='application/zip')
+
+        start = int(match.group(1))
+        if start >= len(self.payload):
+            return web.Response(status=416)
+        return web.Response(
+            status=206, body=self.payload[start:], content_type='application/zip',
+            headers={'Content-Range': f'bytes {start}-{len(self.payload) - 1}/{len(self.payload)}'})
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def benchmark_database_url(database_url):
+    """
+    Point the database URL at the benchmark database, so the catalog is never touched.
+    """
+    if database_url == 'mongomock':
+        return f'mongodb://localhost/{BENCHMARK_DATABASE}'
+    return urlsplit(database_url)._replace(path=f'/{BENCHMARK_DATABASE}').geturl()
+
+
+async def run_crawl(config, storage, vault_url, stats):
+    from src.bulk_writer import BulkUpsertWriter
+    from src.console_data_extractor import ConsoleDataExtractor
+    from src.crawl_frontier import CrawlFrontier
+    from src.crawl_scheduler import CrawlScheduler
+    from src.http_session import create_session, PageFetcher
+    from src.parse_pool import ParsePool
+    from src.rate_control import create_rate_controller
+
+    frontier_path = os.path.join(config.download_path, 'frontier.sqlite')
+    async with create_session(config) as session, \
+            CrawlFrontier(frontier_path, config.frontier_checkpoint_interval) as frontier, \
+            ParsePool(config.parse_workers, config.parser_backend) as parse_pool, \
+            BulkUpsertWriter(storage, 'consoles', 'name', config.db_batch_size,
+                             config.db_flush_interval) as console_writer, \
+            BulkUpsertWriter(storage, 'games', 'GameName', config.db_batch_size,
+                             config.db_flush_interval) as game_writer:
+        scheduler = CrawlScheduler(
+            config.crawl_concurrency, config.crawl_per_host_concurrency, frontier,
+            [console_writer, game_writer])
+        controller = create_rate_controller(
+            config, config.crawl_per_host_concurrency, config.http_latency_target)
+        crawler = ConsoleDataExtractor(
+            vault_url, PageFetcher(session, controller=controller), scheduler, parse_pool,
+            storage, console_writer, game_writer)
+
+        start = time.perf_counter()
+        await crawler.request_site()
+        elapsed = time.perf_counter() - start
+
+    writers = (console_writer, game_writer)
+    written = sum(writer.written for writer in writers)
+    write_seconds = sum(writer.write_seconds for writer in writers)
+    # The listing and game pages, and the vault index
+    pages = sum(progress.listings + progress.games
+                for progress in scheduler.progress.values()) + 1
+
+    stats.update({
+        'crawl_seconds': elapsed,
+        'pages': pages,
+        'pages_per_second': pages / elapsed,
+        'parse_ms_per_page': parse_pool.parse_seconds / max(parse_pool.timed_pages, 1) * 1000,
+        'db_writes': written,
+        'db_writes_per_second': written / write_seconds if write_seconds else 0.0,
+        'games': storage.count('games'),
+    })
+
+
+async def run_downloads(config, storage, console_name, stats):
+    from src.download_engine import DownloadEngine
+    from src.game_download_checker import DownloadStateTracker, GameDownloadChecker
+    from src.http_session import create_session
+    from src.rate_control import create_rate_controller
+
+    async with create_session(config) as session:
+        controller = create_rate_controller(config, config.download_per_host)
+        engine = DownloadEngine(session, config.download_parallel, controller,
+                                config.download_bandwidth_limit, config.download_chunk_size,
+                                config.download_preallocate, config.download_fsync,
+                                config.download_fsync_bytes, config.download_progress_interval,
+                                DownloadStateTracker(storage))
+        checker = GameDownloadChecker({'name': console_name}, engine, storage, config)
+
+        start = time.perf_counter()
+        await checker.check_downloadable_games()
+        elapsed = time.perf_counter() - start
+
+    transferred = engine.progress.transferred if engine.progress else 0
+    stats.update({
+        'download_seconds': elapsed,
+        'downloaded_files': engine.progress.files if engine.progress else 0,
+        'download_mb_per_second': transferred / 1024 ** 2 / elapsed,
+    })
+
+
+async def run(args, download_path):
+    stand_in = VaultStandIn(args.letters, args.downloads, args.download_size * 1024 ** 2,
+                            args.error_rate)
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+
+    os.environ['DATABASE_URL'] = benchmark_database_url(args.database_url)
+    os.environ['DOWNLOAD_PATH'] = download_path
+    os.environ['VAULT_URL'] = f'{base_url}/vault'
+    os.environ['DOWNLOAD_URL'] = f'{base_url}/download/'
+    os.environ['HTTP_CACHE_PATH'] = ''
+    os.environ['STORAGE_BACKEND'] = args.storage
+    os.environ['STORAGE_PATH'] = os.path.join(download_path, 'catalog.sqlite')
+
+    from src.config import Config
+    from src.storage import COLLECTIONS, MongoStorage, SQLiteStorage
+
+    config = Config()
+    if args.storage == 'sqlite':
+        storage = SQLiteStorage(config.storage_path)
+    elif args.database_url == 'mongomock':
+        import mongomock
+        storage = MongoStorage(config.database_url, BENCHMARK_DATABASE,
+                               mongo_client_class=mongomock.MongoClient)
+    else:
+        storage = MongoStorage(config.database_url, BENCHMARK_DATABASE)
+    for collection in COLLECTIONS:
+        storage.clear(collection)
+
+    runner = web.AppRunner(stand_in.application(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    stats = {}
+    try:
+        await run_crawl(config, storage, config.vault_url, stats)
+        if args.downloads:
+            await run_downloads(config, storage, stand_in.consoles[0][1], stats)
+    finally:
+        await runner.cleanup()
+        storage.close()
+
+    from src.metrics import metrics
+    stats['metrics'] = metrics.summary()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--letters', default='ABCDE',
+                        help='letter pages holding games, the others are empty')
+    parser.add_argument('--downloads', type=int, default=8,
+                        help='downloadable games of the first console')
+    parser.add_argument('--download-size', type=int, default=16,
+                        help='size of each download, in MB')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of the requests answered with 503, to exercise the retries')
+    parser.add_argument('--storage', choices=('mongo', 'sqlite'), default='mongo',
+                        help='storage backend to crawl into, sqlite in a temporary file')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL', 'mongomock'),
+                        help="MongoDB server to benchmark against, or 'mongomock' for an in-memory database")
+    parser.add_argument('--json', action='store_true',
+                        help='print the results, and the metrics of every stage, as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as download_path:
+        stats = asyncio.run(run(args, download_path))
+
+    if args.json:
+        print(json.dumps(stats, indent=4))
+        return 0
+
+    print()
+    print(f"Crawl:     {stats['pages']} pages in {stats['crawl_seconds']:.2f} s, "
+          f"{stats['pages_per_second']:.1f} pages/sec ({stats['games']} games)")
+    print(f"Parse:     {stats['parse_ms_per_page']:.2f} ms/page")
+    print(f"Database:  {stats['db_writes']} writes, {stats['db_writes_per_second']:.0f} writes/sec")
+    if 'download_seconds' in stats:
+        print(f"Downloads: {stats['downloaded_files']} files in {stats['download_seconds']:.2f} s, "
+              f"{stats['download_mb_per_second']:.1f} MB/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Measures the verification of downloaded archives, in one pass against separate passes.
+
+`--archives` synthetic zip archives of `--size` MB (a compressible image each) are
+written to a temporary folder, then verified the way the ad-hoc scripts did (a CRC
+test of the archive, then another read of the image to hash it, and another to extract
+it with `--extract`), and with ArchiveVerifier streaming each archive once on pools of
+`--workers` processes. The archives were just written, so they are likely read from the
+page cache: the figures are the CPU bound ceiling of the verification.
+
+    python -m benchmarks.verify_benchmark
+    python -m benchmarks.verify_benchmark --archives 16 --size 256 --workers 1 4 all --extract
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+# Random bytes mapped to 16 values, which deflate to about half their size
+COMPRESSIBLE = bytes(range(16)) * 16
+
+
+def create_archives(directory, count, size):
+    paths = []
+    for number in range(count):
+        path = os.path.join(directory, 'Benchmark', f'Game {number}.zip')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive, \
+                archive.open('game.iso', 'w', force_zip64=True) as image:
+            for _ in range(size):
+                image.write(os.urandom(1024 * 1024).translate(COMPRESSIBLE))
+        paths.append(path)
+    return paths
+
+
+def separate_passes(paths, extract_path, block_size):
+    """
+    Verify the archives one after the other, reading each of them once per step.
+    """
+    for path in paths:
+        with zipfile.ZipFile(path) as archive:
+            if archive.testzip():
+                raise IOError(f"{path} is corrupt")
+            for info in archive.infolist():
+                md5 = hashlib.md5()
+                sha1 = hashlib.sha1()
+                with archive.open(info) as member:
+                    while block := member.read(block_size):
+                        md5.update(block)
+                        sha1.update(block)
+            if extract_path:
+                archive.extractall(os.path.join(extract_path, os.path.basename(path)))
+
+
+async def single_pass(paths, workers, extract_path, block_size):
+    from src.archive_verifier import ArchiveVerifier
+
+    async with ArchiveVerifier(None, workers, extract_path, block_size=block_size) as verifier:
+        for path in paths:
+            verifier.submit(path)
+    if any(verifier.outcomes[outcome] for outcome in ('corrupt', 'failed')):
+        raise IOError("an archive failed verification")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--archives', type=int, default=8, help='archives to verify')
+    parser.add_argument('--size', type=int, default=64, help='size of each image, in MB')
+    parser.add_argument('--workers', nargs='+', default=['1', 'all'],
+                        help='pool sizes to verify with, "all" for one process per core')
+    parser.add_argument('--extract', action='store_true', help='extract the images as well')
+    parser.add_argument('--block-size', type=int, default=1024 * 1024,
+                        help='bytes read from an archive at a time')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    stats = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = create_archives(directory, args.archives, args.size)
+        archive_mb = sum(os.path.getsize(path) for path in paths) / 1024 ** 2
+
+        def measure(name, run, *arguments):
+            extract_path = os.path.join(directory, 'images', name) if args.extract else ''
+            start = time.perf_counter()
+            run(paths, *arguments, extract_path, args.block_size)
+            elapsed = time.perf_counter() - start
+            stats[name] = {'seconds': elapsed, 'mb_per_second': archive_mb / elapsed}
+
+        measure('separate passes', separate_passes)
+        for workers in args.workers:
+            measure(f'single pass, {workers} workers',
+                    lambda *arguments: asyncio.run(single_pass(*arguments)),
+                    None if workers == 'all' else int(workers))
+
+    if args.json:
+        print(json.dumps(stats, indent=4))
+        return 0
+
+    print(f"{args.archives} archives, {archive_mb:.0f} MB compressed, "
+          f"{args.archives * args.size} MB of images, {os.cpu_count()} cores")
+    for name, result in stats.items():
+        print(f"{name:26} {result['seconds']:7.2f} s {result['mb_per_second']:8.1f} MB/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
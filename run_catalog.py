@@ -0,0 +1,72 @@
+import argparse
+import logging
+import os
+import time
+from src.catalog_snapshot import export_snapshot, import_mongodump, import_snapshot, \
+    snapshot_date
+from src.config import Config
+from src.storage import create_storage
+
+
+def export(args, config, storage):
+    since = snapshot_date(args.since) if args.since else None
+    start = time.perf_counter()
+    manifest = export_snapshot(storage, args.path, since, config.snapshot_chunk_size,
+                               config.snapshot_workers)
+    counts = {collection: entry['documents']
+              for collection, entry in manifest['collections'].items()}
+    logging.info("Exported %d consoles and %d games%s to %s in %.1f s.",
+                 counts['consoles'], counts['games'],
+                 f" updated since {manifest['since']}" if since else '', args.path,
+                 time.perf_counter() - start)
+
+
+def restore(args, config, storage):
+    # Snapshots are imported in the order given, e.g. a full one then incremental ones
+    for path in args.paths:
+        start = time.perf_counter()
+        if os.path.isdir(path):
+            results = import_snapshot(storage, path, config.snapshot_workers)
+        else:
+            results = import_mongodump(storage, path, config.snapshot_chunk_size,
+                                       config.snapshot_workers)
+        for collection, result in results.items():
+            logging.info("Imported %s from %s: %d new, %d updated, %d unchanged, %d errors.",
+                         collection, path, result.new, result.updated, result.unchanged,
+                         len(result.errors))
+        logging.info("Imported %s in %.1f s.", path, time.perf_counter() - start)
+
+
+def main(args):
+
+    config = Config()
+    logging.basicConfig(level=config.log_level,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    storage = create_storage(config)
+    try:
+        args.command(args, config, storage)
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Export the catalog to a snapshot, or seed the catalog from snapshots.")
+    commands = parser.add_subparsers(required=True)
+
+    export_parser = commands.add_parser(
+        'export', help='write the consoles and games to a new snapshot folder')
+    export_parser.add_argument('path', help='folder of the snapshot')
+    export_parser.add_argument('--since', metavar='DATE_OR_SNAPSHOT',
+                               help='only export the documents updated since an ISO 8601 '
+                                    'date, or since a previous snapshot folder was exported')
+    export_parser.set_defaults(command=export)
+
+    import_parser = commands.add_parser(
+        'import', help='upsert the consoles and games of snapshots or mongodump archives')
+    import_parser.add_argument('paths', nargs='+', metavar='path',
+                               help='snapshot folder, or gzipped mongodump archive')
+    import_parser.set_defaults(command=restore)
+
+    main(parser.parse_args())
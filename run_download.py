@@ -1,18 +1,63 @@
+import argparse
 import asyncio
-from src.game_download_checker import GameDownloadChecker
+import logging
+from contextlib import nullcontext
+from src.archive_verifier import ArchiveVerifier
+from src.config import Config
+from src.download_engine import DownloadEngine
+from src.game_download_checker import DownloadStateTracker, GameDownloadChecker
+from src.http_session import create_session
+from src.metrics import metrics, MetricsExporter
+from src.rate_control import create_rate_controller
+from src.storage import create_storage
 
 
-async def main():
+async def main(args):
 
-    # Console data this time is a dictionary with the name of the console
-    console_data = {'name': 'GameCube'}
+    config = Config()
+    logging.basicConfig(level=config.log_level,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
-    # Creating the GameDownloadChecker object
-    download_checker = GameDownloadChecker(console_data)
+    storage = create_storage(config)
+    try:
+        consoles = args.consoles
+        if [console.lower() for console in consoles] == ['all']:
+            consoles = await asyncio.to_thread(storage.get_console_names)
 
-    # Veryfing if the games are downloadable
-    await download_checker.check_downloadable_games()
+        # The archives are verified and hashed on a process pool as they are downloaded
+        verifier = nullcontext()
+        if config.verify_downloads:
+            verifier = ArchiveVerifier(storage, config.verify_workers, config.extract_path,
+                                       config.extract_layout, config.download_chunk_size)
+
+        async with MetricsExporter(metrics, config.metrics_port, config.metrics_summary_path,
+                                   config.metrics_summary_interval), \
+                create_session(config) as session, \
+                verifier as verifier:
+            controller = create_rate_controller(config, config.download_per_host)
+            engine = DownloadEngine(session, config.download_parallel, controller,
+                                    config.download_bandwidth_limit, config.download_chunk_size,
+                                    config.download_preallocate, config.download_fsync,
+                                    config.download_fsync_bytes,
+                                    config.download_progress_interval,
+                                    DownloadStateTracker(storage), verifier)
+
+            for console_name in consoles:
+                # Console data this time is a dictionary with the name of the console
+                download_checker = GameDownloadChecker(
+                    {'name': console_name}, engine, storage, config)
+
+                # Veryfing if the games are downloadable
+                await download_checker.check_downloadable_games(args.reconcile)
+    finally:
+        storage.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(
+        description="Download the games of consoles found by the crawl.")
+    parser.add_argument('--consoles', nargs='+', metavar='CONSOLE', default=['all'],
+                        help='consoles to download the games of, by name, or "all"')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='rescan the download folder to update the download state of the games')
+    asyncio.run(main(parser.parse_args()))
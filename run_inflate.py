@@ -1,13 +1,75 @@
+import argparse
 import asyncio
+import logging
+from contextlib import nullcontext
+from src.bulk_writer import BulkUpsertWriter
+from src.config import Config
 from src.console_data_extractor import ConsoleDataExtractor
+from src.crawl_frontier import CrawlFrontier
+from src.crawl_scheduler import CrawlScheduler
+from src.http_cache import HttpCache
+from src.http_session import create_session, PageFetcher
+from src.metrics import metrics, MetricsExporter
+from src.parse_pool import ParsePool
+from src.rate_control import create_rate_controller
+from src.storage import create_storage
 
 
-async def main():
+async def main(args):
 
-    url_console = 'https://vimm.net/vault'
-    crawler = ConsoleDataExtractor(url_console)
-    await crawler.request_site()
+    config = Config()
+    logging.basicConfig(level=config.log_level,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    url_console = config.vault_url
+
+    http_cache = nullcontext()
+    if config.http_cache_path:
+        http_cache = HttpCache(config.http_cache_path, config.http_cache_max_size)
+
+    # One connection pool for the whole crawl, shared by every extractor.
+    # The writers flush whatever they still buffer when the crawl ends.
+    storage = create_storage(config)
+    try:
+        async with MetricsExporter(metrics, config.metrics_port, config.metrics_summary_path,
+                                   config.metrics_summary_interval), \
+                create_session(config) as session, \
+                http_cache as cache, \
+                CrawlFrontier(config.frontier_path,
+                              config.frontier_checkpoint_interval) as frontier, \
+                ParsePool(config.parse_workers, config.parser_backend, config.profile_sample_rate,
+                          config.profile_path, config.profile_memory) as parse_pool, \
+                BulkUpsertWriter(storage, 'consoles', 'name', config.db_batch_size,
+                                 config.db_flush_interval) as console_writer, \
+                BulkUpsertWriter(storage, 'games', 'GameName', config.db_batch_size,
+                                 config.db_flush_interval) as game_writer:
+            controller = create_rate_controller(
+                config, config.crawl_per_host_concurrency, config.http_latency_target)
+            fetcher = PageFetcher(session, cache, controller)
+            scheduler = CrawlScheduler(
+                config.crawl_concurrency, config.crawl_per_host_concurrency, frontier,
+                [console_writer, game_writer])
+            if args.resume:
+                scheduler.resume()
+            else:
+                frontier.reset()
+
+            crawler = ConsoleDataExtractor(
+                url_console, fetcher, scheduler, parse_pool, storage, console_writer, game_writer,
+                args.consoles, args.letters, args.incremental, config.crawl_reverify_rate)
+            await crawler.request_site()
+    finally:
+        storage.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(
+        description="Crawl the Vimm's Lair vault into the storage.")
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted crawl instead of starting over')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch the game pages whose listing row changed since the last crawl')
+    parser.add_argument('--consoles', nargs='+', metavar='CONSOLE',
+                        help='crawl only these consoles, by name or URL slug (e.g. NES "Game Boy")')
+    parser.add_argument('--letters', type=str.upper,
+                        help='crawl only the listing pages of these letters (e.g. ABC)')
+    asyncio.run(main(parser.parse_args()))
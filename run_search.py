@@ -0,0 +1,46 @@
+import argparse
+import asyncio
+import logging
+import time
+from aiohttp import web
+from src.catalog_search import CatalogSearch
+from src.config import Config
+from src.metrics import metrics, MetricsExporter
+from src.storage import create_storage
+
+
+async def main(args):
+
+    config = Config()
+    logging.basicConfig(level=config.log_level,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    storage = create_storage(config)
+    runner = None
+    try:
+        search = CatalogSearch(storage, config.search_cache_size, config.search_refresh_interval,
+                               config.search_min_similarity)
+        start = time.perf_counter()
+        await search.refresh()
+        logging.info("Indexed %d games of %d consoles in %.1f s.", len(search.index.games),
+                     len(search.consoles), time.perf_counter() - start)
+
+        runner = web.AppRunner(search.application(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', config.search_port).start()
+        logging.info("Serving the catalog search on port %d", config.search_port)
+
+        async with MetricsExporter(metrics, config.metrics_port, config.metrics_summary_path,
+                                   config.metrics_summary_interval):
+            # Until interrupted, following the writes of the crawl
+            await search.refresh_periodically()
+    finally:
+        if runner:
+            await runner.cleanup()
+        storage.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Serve a read-only search API over the catalog, following the crawl's writes.")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import logging
+import os
+from src.archive_verifier import ArchiveVerifier, find_archives
+from src.config import Config
+from src.metrics import metrics, MetricsExporter
+from src.storage import create_storage
+
+
+async def main(args):
+
+    config = Config()
+    logging.basicConfig(level=config.log_level,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    consoles = args.consoles
+    if [console.lower() for console in consoles] == ['all']:
+        # Every console folder of the download path, whether the catalog knows it or not
+        consoles = sorted(entry.name for entry in os.scandir(config.download_path)
+                          if entry.is_dir())
+
+    storage = create_storage(config)
+    try:
+        archives = []
+        for console_name in consoles:
+            archives += await asyncio.to_thread(
+                find_archives, storage, config.download_path, console_name, args.all)
+        # The largest archives first, so the pool doesn't end on a single long one
+        archives.sort(key=lambda archive: archive[1], reverse=True)
+        logging.info("Verifying %d archives (%.1f GB).", len(archives),
+                     sum(size for _, size, _ in archives) / 1024 ** 3)
+
+        async with MetricsExporter(metrics, config.metrics_port, config.metrics_summary_path,
+                                   config.metrics_summary_interval), \
+                ArchiveVerifier(storage, config.verify_workers, config.extract_path,
+                                config.extract_layout, config.download_chunk_size,
+                                args.remove_corrupt) as verifier:
+            for path, _, game_id in archives:
+                if game_id is None:
+                    logging.warning("%s matches no game of the catalog, its verification "
+                                    "is not saved.", path)
+                verifier.submit(path, game_id)
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Verify, hash and optionally extract the archives already downloaded.")
+    parser.add_argument('--consoles', nargs='+', metavar='CONSOLE', default=['all'],
+                        help='consoles to verify the archives of, by folder name, or "all"')
+    parser.add_argument('--all', action='store_true',
+                        help='verify the archives verified already as well')
+    parser.add_argument('--remove-corrupt', action='store_true',
+                        help='delete the corrupt archives and mark their download failed, '
+                             'so run_download.py fetches them again')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import logging
+from contextlib import nullcontext
+from src.archive_verifier import ArchiveVerifier
+from src.bulk_writer import BulkUpsertWriter
+from src.config import Config
+from src.console_data_extractor import ConsoleDataExtractor
+from src.download_engine import DownloadEngine
+from src.game_download_checker import DownloadStateTracker, GameDownloadChecker
+from src.http_cache import HttpCache
+from src.http_session import create_session, PageFetcher
+from src.metrics import metrics, MetricsExporter
+from src.parse_pool import ParsePool
+from src.rate_control import create_rate_controller
+from src.storage import create_storage
+from src.work_queue import QueueScheduler, WorkQueue
+
+# Kinds of the work queue items handled by each role
+CRAWL_KINDS = ('console', 'listing', 'game')
+DOWNLOAD_KINDS = ('download',)
+
+
+def create_work_queue(config, storage, kinds):
+    return WorkQueue(storage, kinds, config.worker_id, config.queue_lease,
+                     config.queue_heartbeat_interval, config.queue_max_attempts,
+                     config.queue_poll_interval, config.frontier_checkpoint_interval)
+
+
+async def crawl(args, config, storage, consoles):
+    """
+    Queue the selected consoles, then crawl the pages claimed from the queue
+    until no worker has any left.
+    """
+    queue = create_work_queue(config, storage, CRAWL_KINDS)
+
+    http_cache = nullcontext()
+    if config.http_cache_path:
+        http_cache = HttpCache(config.http_cache_path, config.http_cache_max_size)
+
+    async with create_session(config) as session, \
+            http_cache as cache, \
+            ParsePool(config.parse_workers, config.parser_backend, config.profile_sample_rate,
+                      config.profile_path, config.profile_memory) as parse_pool, \
+            BulkUpsertWriter(storage, 'consoles', 'name', config.db_batch_size,
+                             config.db_flush_interval) as console_writer, \
+            BulkUpsertWriter(storage, 'games', 'GameName', config.db_batch_size,
+                             config.db_flush_interval) as game_writer:
+        controller = create_rate_controller(
+            config, config.crawl_per_host_concurrency, config.http_latency_target)
+        fetcher = PageFetcher(session, cache, controller)
+        scheduler = QueueScheduler(
+            config.crawl_concurrency, config.crawl_per_host_concurrency, queue,
+            [console_writer, game_writer])
+
+        crawler = ConsoleDataExtractor(
+            config.vault_url, fetcher, scheduler, parse_pool, storage, console_writer,
+            game_writer, consoles, args.letters, args.incremental, config.crawl_reverify_rate)
+        await crawler.request_site()
+
+
+async def download(args, config, storage, consoles):
+    """
+    Queue the games of the selected consoles that are not downloaded yet, then download
+    the games claimed from the queue until no worker has any left.
+    """
+    queue = create_work_queue(config, storage, DOWNLOAD_KINDS)
+
+    verifier = nullcontext()
+    if config.verify_downloads:
+        verifier = ArchiveVerifier(storage, config.verify_workers, config.extract_path,
+                                   config.extract_layout, config.download_chunk_size)
+
+    async with create_session(config) as session, verifier as verifier:
+        controller = create_rate_controller(config, config.download_per_host)
+        engine = DownloadEngine(session, config.download_parallel, controller,
+                                config.download_bandwidth_limit, config.download_chunk_size,
+                                config.download_preallocate, config.download_fsync,
+                                config.download_fsync_bytes, config.download_progress_interval,
+                                DownloadStateTracker(storage), verifier)
+        scheduler = QueueScheduler(config.download_parallel, config.download_per_host, queue)
+        scheduler.register(
+            'download', GameDownloadChecker(None, engine, storage, config).download_game)
+
+        if consoles is None:
+            consoles = await asyncio.to_thread(storage.get_console_names)
+        for console_name in consoles:
+            checker = GameDownloadChecker({'name': console_name}, engine, storage, config)
+            await checker.enqueue_downloadable_games(scheduler, args.reconcile)
+
+        engine.open_progress()
+        try:
+            await scheduler.run()
+        finally:
+            engine.close_progress()
+
+
+async def main(args):
+
+    config = Config()
+    logging.basicConfig(level=config.log_level,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    consoles = None if [console.lower() for console in args.consoles] == ['all'] \
+        else args.consoles
+
+    storage = create_storage(config)
+    try:
+        if args.reset:
+            kinds = (CRAWL_KINDS if 'crawl' in args.roles else ()) + \
+                (DOWNLOAD_KINDS if 'download' in args.roles else ())
+            await asyncio.to_thread(create_work_queue(config, storage, kinds).reset)
+
+        async with MetricsExporter(metrics, config.metrics_port, config.metrics_summary_path,
+                                   config.metrics_summary_interval):
+            # The downloads are queued once the whole crawl is saved
+            if 'crawl' in args.roles:
+                await crawl(args, config, storage, consoles)
+            if 'download' in args.roles:
+                await download(args, config, storage, consoles)
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Crawl and download from a work queue shared by any number of workers.")
+    parser.add_argument('roles', nargs='+', choices=('crawl', 'download'),
+                        help='crawl the vault, then download the games, or both in that order')
+    parser.add_argument('--consoles', nargs='+', metavar='CONSOLE', default=['all'],
+                        help='consoles to queue, by name (or URL slug for the crawl), or "all"')
+    parser.add_argument('--letters', type=str.upper,
+                        help='crawl only the listing pages of these letters (e.g. ABC)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch the game pages whose listing row changed since the last crawl')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='rescan the download folder before queueing the downloads')
+    parser.add_argument('--reset', action='store_true',
+                        help='clear the queue of the roles first, to start a new run; '
+                             'start the other workers once this one is running')
+    asyncio.run(main(parser.parse_args()))
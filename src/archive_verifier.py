@@ -0,0 +1,220 @@
+"""
+Verification of the downloaded archives, hashing and extracting the games' images.
+
+Every archive is streamed once, on a pool of worker processes: each file inside it is
+decompressed block by block into its MD5 and SHA-1, and written to the extract folder
+when one is configured. zipfile checks the CRC-32 of every file as it reaches its end,
+so the CRC-32 recorded is the archive's own, verified. The hashes and sizes are saved
+on the game's document as its Verification.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from src.game_download_checker import sanitize_filename
+from src.metrics import VERIFICATIONS, VERIFY_BYTES, VERIFY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Errors of an archive whose content can't be read back as it was packed
+CORRUPT_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError)
+
+
+def extract_target(directory, name):
+    """
+    Get where a file of an archive is extracted to, refusing names that leave the directory.
+    """
+    directory = os.path.normpath(directory)
+    path = os.path.normpath(os.path.join(directory, name))
+    if os.path.isabs(name) or os.path.commonpath([directory, path]) != directory:
+        raise zipfile.BadZipFile(f"unsafe file name in the archive: {name}")
+    return path
+
+
+def hash_file(archive, info, block_size, target=None):
+    """
+    Stream a file of the archive into its MD5 and SHA-1, and to the target path if given.
+    The target is written to a .part file, only renamed once the file's CRC-32 checked out.
+    """
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    output = None
+    if target:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        output = open(target + '.part', 'wb')
+    try:
+        with archive.open(info) as member:
+            while block := member.read(block_size):
+                md5.update(block)
+                sha1.update(block)
+                if output:
+                    output.write(block)
+    except BaseException:
+        if output:
+            output.close()
+            os.remove(target + '.part')
+        raise
+    if output:
+        output.close()
+        os.replace(target + '.part', target)
+
+    return {'name': info.filename, 'size': info.file_size, 'crc32': f'{info.CRC:08x}',
+            'md5': md5.hexdigest(), 'sha1': sha1.hexdigest()}
+
+
+def verify_archive(path, extract_directory=None, block_size=1024 * 1024):
+    """
+    Read every file of the archive once, and get the archive's size and the name, size,
+    CRC-32, MD5 and SHA-1 of each file. With an `extract_directory`, the files are
+    extracted there in the same pass.
+
+    Raises one of CORRUPT_ERRORS for a corrupt archive.
+    """
+    files = []
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            target = extract_target(extract_directory, info.filename) \
+                if extract_directory else None
+            files.append(hash_file(archive, info, block_size, target))
+    return {'archive_size': os.path.getsize(path), 'files': files}
+
+
+def find_archives(storage, download_path, console_name, again=False):
+    """
+    Get the (path, size, game _id) of the archives in the console's download folder.
+    Archives verified already at their current size are left out, unless `again` is set. The _id is None for an archive that matches no game of the catalog.
+    """
+    directory = os.path.join(download_path, console_name)
+    if not os.path.isdir(directory):
+        return []
+    games = {sanitize_filename(f"{game['GameName']}.zip"): game
+             for game in storage.get_verification_states(console_name)}
+
+    archives = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith('.zip'):
+                continue
+            size = entry.stat().st_size
+            game = games.get(entry.name)
+            if game and not again and game['status'] == 'verified' \
+                    and game['archive_size'] == size:
+                continue
+            archives.append((entry.path, size, game['_id'] if game else None))
+    return archives
+
+
+class ArchiveVerifier:
+    """
+    Verifies archives on a pool of `workers` processes, and saves the results on the games.
+
+    With `workers` set to None the pool has one process per core, so the archives are
+    read at disk speed; with 0 they are verified on a thread. submit() starts verifying
+    an archive in the background, e.g. as soon as it is downloaded, and leaving the
+    `async with` block waits for every verification.
+
+    With an `extract_path`, the files of each archive are extracted to the folder given
+    by `extract_layout` under it, formatted with the archive's {console} and {game}.
+    With `remove_corrupt`, a corrupt archive is deleted and its download marked failed,
+    so the next download run fetches it again.
+    """
+
+    def __init__(self, storage, workers=None, extract_path='', extract_layout='{console}/{game}',
+                 block_size=1024 * 1024, remove_corrupt=False):
+        self.storage = storage
+        self.executor = None
+        if workers != 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.extract_path = extract_path
+        self.extract_layout = extract_layout
+        self.block_size = block_size
+        self.remove_corrupt = remove_corrupt
+        self.tasks = set()
+        self.started = time.monotonic()
+        self.outcomes = {status: 0 for status in ('verified', 'corrupt', 'failed')}
+        self.bytes = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.join()
+        finally:
+            self.close()
+
+    def submit(self, path, game_id=None):
+        """
+        Verify the archive in the background.
+        """
+        task = asyncio.create_task(self.verify(path, game_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    async def verify(self, path, game_id=None):
+        """
+        Verify the archive and save the result on its game. Returns the verification state.
+        An archive still being downloaded is verified as its .part file.
+        """
+        console = os.path.basename(os.path.dirname(path))
+        game = os.path.splitext(os.path.basename(path.removesuffix('.part')))[0]
+        extract_directory = None
+        if self.extract_path:
+            extract_directory = os.path.join(
+                self.extract_path, self.extract_layout.format(console=console, game=game))
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            state = await loop.run_in_executor(
+                self.executor, verify_archive, path, extract_directory, self.block_size)
+            state.update(status='verified', extracted_to=extract_directory)
+            VERIFY_BYTES.inc(state['archive_size'], console=console)
+            VERIFY_SECONDS.observe(time.perf_counter() - start, console=console)
+            self.bytes += state['archive_size']
+            logger.info("Verified %s.", path)
+        except CORRUPT_ERRORS as e:
+            state = {'status': 'corrupt', 'error': str(e)}
+            logger.error("Archive %s is corrupt: %s", path, e)
+        except Exception as e:
+            state = {'status': 'failed', 'error': str(e)}
+            logger.error("Error verifying %s: %s", path, e)
+        state['updated_at'] = datetime.now(timezone.utc)
+
+        self.outcomes[state['status']] += 1
+        VERIFICATIONS.inc(console=console, outcome=state['status'])
+        if game_id is not None:
+            await asyncio.to_thread(self.storage.save_verifications, [(game_id, state)])
+        if state['status'] == 'corrupt' and self.remove_corrupt:
+            await asyncio.to_thread(self.discard, path, game_id, state)
+        return state
+
+    def discard(self, path, game_id, state):
+        os.remove(path)
+        if game_id is not None:
+            self.storage.save_download_states([(game_id, {
+                'status': 'failed', 'error': f"archive verification failed: {state['error']}",
+                'updated_at': state['updated_at']})])
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        archives = sum(self.outcomes.values())
+        if archives:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            logger.info(
+                "Checked %d archives (%d corrupt, %d failed), %.1f MB in %.1f s (%.1f MB/s).",
+                archives, self.outcomes['corrupt'], self.outcomes['failed'],
+                self.bytes / 1024 ** 2, elapsed, self.bytes / 1024 ** 2 / elapsed)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from src.metrics import DB_RECORDS, DB_WRITE_SECONDS
+from src.records import to_storage
+
+logger = logging.getLogger(__name__)
+
+
+class BulkUpsertWriter:
+    """
+    Buffers records and writes them to a collection of the storage as bulk upserts keyed on one field.
+    Records are the dataclasses of src.records, or dicts holding some fields of a document.
+
+    The buffer is flushed when it holds `batch_size` records, every `flush_interval` seconds
+    and when the writer is closed. Writes run on a worker thread so the event loop keeps
+    fetching while the database works. A record can come with a callback, called on the
+    worker thread once the record is saved, e.g. to remember the crawled page it came
+    from only when nothing of it can be lost anymore. A batch whose write fails, e.g. while the database
+    is unreachable or locked, goes back to the front of the buffer for the next flush.
+    """
+
+    def __init__(self, storage, collection, key, batch_size, flush_interval):
+        self.storage = storage
+        self.collection = collection
+        self.key = key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.callbacks = []
+        self.lock = asyncio.Lock()
+        self.closing = asyncio.Event()
+        self.flusher = None
+        self.written = 0
+        self.write_seconds = 0.0
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def start(self):
+        """
+        Start flushing the buffer every `flush_interval` seconds.
+        """
+        self.flusher = asyncio.create_task(self.flush_periodically())
+
+    async def close(self):
+        """
+        Stop the periodic flush and write whatever is left in the buffer.
+        """
+        # Let the periodic flush finish on its own, cancelling it could abandon a write in progress
+        self.closing.set()
+        if self.flusher:
+            await self.flusher
+            self.flusher = None
+        await self.flush()
+
+    async def add(self, record, saved=None):
+        """
+        Buffer a record, flushing the buffer if it is full.
+        `saved` is called without arguments once the record is written.
+        """
+        self.buffer.append(record)
+        if saved:
+            self.callbacks.append(saved)
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.buffer:
+                return
+            records, self.buffer = self.buffer, []
+            callbacks, self.callbacks = self.callbacks, []
+            try:
+                await asyncio.to_thread(self.write, records, callbacks)
+            except BaseException:
+                # Keep the batch, ahead of the records added during the write
+                self.buffer[:0] = records
+                self.callbacks[:0] = callbacks
+                raise
+
+    async def flush_periodically(self):
+        while not self.closing.is_set():
+            try:
+                await asyncio.wait_for(self.closing.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                # The records stay buffered, the next flush tries them again
+                logger.error("Error writing %d records to '%s': %s",
+                             len(self.buffer), self.collection, e)
+
+    def write(self, records, callbacks=()):
+        """
+        Upsert the records in a single unordered bulk write, then call the callbacks of
+        the batch unless a record failed.
+        """
+        # Merge the records of each key, later fields winning, so a batch never upserts
+        # the same key twice and a partial record doesn't drop the fields of another.
+        # Records only become documents here, as the batch is written.
+        merged = {}
+        for record in records:
+            document = to_storage(record)
+            merged.setdefault(document[self.key], {}).update(document)
+
+        start = time.perf_counter()
+        result = self.storage.upsert(self.collection, self.key, list(merged.values()))
+        elapsed = time.perf_counter() - start
+        self.written += len(merged) - len(result.errors)
+        self.write_seconds += elapsed
+
+        DB_WRITE_SECONDS.observe(elapsed, collection=self.collection)
+        DB_RECORDS.inc(result.new, collection=self.collection, result='new')
+        DB_RECORDS.inc(result.updated, collection=self.collection, result='updated')
+        DB_RECORDS.inc(result.unchanged, collection=self.collection, result='unchanged')
+        if result.errors:
+            DB_RECORDS.inc(len(result.errors), collection=self.collection, result='error')
+            logger.error("Error saving records to '%s': %s", self.collection, result.errors)
+            return
+        logger.info("Saved %d records to '%s' (%d new, %d updated).", len(merged),
+                    self.collection, result.new, result.updated)
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                # The records are saved, only what the callback remembers is lost
+                logger.error("Error after saving records to '%s': %s", self.collection, e)
@@ -0,0 +1,292 @@
+"""
+Read-only search over the crawled catalog, served as a JSON API by run_search.py.
+
+The games are held in memory by a GameIndex: every normalized GameName is split in
+trigrams, and each trigram and each filter value (Console, Region, Year, CanBeDownloaded)
+maps to the games holding it. A query only scores the games sharing trigrams with it,
+among those matching the filters, so it never scans the catalog. Results are kept in an
+LRU cache.
+
+CatalogSearch follows the writes of the crawl through the UpdatedAt date of the documents:
+every few seconds it reads the games updated since its last refresh, re-indexes those
+that changed, and clears the cache when any did. Games deleted, or imported with the older
+UpdatedAt of a snapshot, change the number of games instead, and the whole catalog is
+read again.
+"""
+import asyncio
+import heapq
+import logging
+import re
+import time
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime, timedelta, timezone
+from aiohttp import web
+from src.catalog_snapshot import LOCAL_FIELDS
+from src.metrics import SEARCHES, SEARCH_SECONDS
+from src.storage import dumps
+
+logger = logging.getLogger(__name__)
+
+# Scoring a game against a query costs about this many posting entries counted
+SCORE_COST = 10
+
+# Fields the games can be filtered on, by query parameter
+FILTERS = {'console': 'Console', 'region': 'Region', 'year': 'Year',
+           'downloadable': 'CanBeDownloaded'}
+MAX_LIMIT = 100
+
+# Games updated this long before the last refresh are read again, as a document's
+# UpdatedAt is set before its write is committed, maybe on a host whose clock is a bit off
+REFRESH_OVERLAP = timedelta(seconds=60)
+
+
+def normalize(text):
+    """
+    Lowercase the text, drop its accents and punctuation, and separate its words by spaces.
+    """
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(character for character in text if not unicodedata.combining(character))
+    return ' '.join(re.findall(r'[^\W_]+', text.lower()))
+
+
+def trigrams(text):
+    """
+    Get the trigrams of the words of a normalized text. Like pg_trgm, each word is padded
+    with two spaces in front and one after, so matching word beginnings weighs more.
+    """
+    grams = set()
+    for word in text.split():
+        padded = f'  {word} '
+        grams.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return grams
+
+
+def filter_value(value):
+    # Filters match regardless of case, and booleans as 'true' or 'false'
+    return None if value is None else str(value).lower()
+
+
+class GameIndex:
+    """
+    The games by name, with the sets of game names holding each title trigram and each
+    filter value.
+    """
+
+    def __init__(self, min_similarity=0.5):
+        self.min_similarity = min_similarity
+        self.games = {}
+        self.names = {}
+        self.grams = {}
+        self.postings = defaultdict(set)
+        self.values = {field: defaultdict(set) for field in FILTERS.values()}
+        # Names of the games left out for having none, e.g. None for a page without a title
+        self.unnamed = set()
+
+    def add(self, game):
+        """
+        Index a game, in place of the indexed game of the same name. Returns whether it
+        changed anything.
+        """
+        name = game.get('GameName')
+        if not name:
+            self.unnamed.add(name)
+            return False
+        if self.games.get(name) == game:
+            return False
+        if name in self.games:
+            self.remove(name)
+
+        self.games[name] = game
+        self.names[name] = normalize(name)
+        self.grams[name] = trigrams(self.names[name])
+        for gram in self.grams[name]:
+            self.postings[gram].add(name)
+        for field, values in self.values.items():
+            values[filter_value(game.get(field))].add(name)
+        return True
+
+    def remove(self, name):
+        game = self.games.pop(name)
+        del self.names[name]
+        for gram in self.grams.pop(name):
+            self.postings[gram].discard(name)
+            if not self.postings[gram]:
+                del self.postings[gram]
+        for field, values in self.values.items():
+            value = filter_value(game.get(field))
+            values[value].discard(name)
+            if not values[value]:
+                del values[value]
+
+    def search(self, query='', filters=None, limit=20, offset=0):
+        """
+        Get the number of games matching the query and the filters, and a page of them.
+
+        A game matches a query when its title holds `min_similarity` of the query's
+        trigrams. Titles containing the query come first, then the most similar and the
+        shortest. Without a query, the games matching the filters are sorted by title.
+        """
+        candidates = None
+        # Intersect the smallest sets first
+        for matches in sorted((self.values[FILTERS[name]].get(filter_value(value), set())
+                               for name, value in (filters or {}).items()), key=len):
+            candidates = matches if candidates is None else candidates & matches
+
+        query = normalize(query)
+        if not query:
+            names = self.games.keys() if candidates is None else candidates
+            ranked = heapq.nsmallest(offset + limit, names, key=lambda name: self.names[name])
+            return len(names), [self.games[name] for name in ranked[offset:]]
+
+        grams = trigrams(query)
+        postings = [self.postings.get(gram, ()) for gram in grams]
+        if candidates is not None and len(candidates) * SCORE_COST < sum(map(len, postings)):
+            # The filters are more selective than the trigrams, score their games directly
+            shared = {name: len(grams & self.grams[name]) for name in candidates}
+        else:
+            shared = Counter()
+            for names in postings:
+                shared.update(names)
+            if candidates is not None:
+                shared = {name: count for name, count in shared.items() if name in candidates}
+
+        minimum = max(len(grams) * self.min_similarity, 1)
+        matches = [(name, count) for name, count in shared.items() if count >= minimum]
+        ranked = heapq.nsmallest(offset + limit, (
+            (query not in self.names[name], -count, len(self.names[name]), name)
+            for name, count in matches))
+        return len(matches), [self.games[name] for *_, name in ranked[offset:]]
+
+    def count(self, field, value):
+        return len(self.values[field].get(filter_value(value), ()))
+
+    def __len__(self):
+        """
+        The number of games read, indexed or not.
+        """
+        return len(self.games) + len(self.unnamed)
+
+
+class CatalogSearch:
+    """
+    The catalog as seen by the search API: the games indexed in memory and refreshed from
+    the storage every `refresh_interval` seconds, and the last `cache_size` results.
+    """
+
+    def __init__(self, storage, cache_size=1024, refresh_interval=5.0, min_similarity=0.5):
+        self.storage = storage
+        self.index = GameIndex(min_similarity)
+        self.consoles = {}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.refresh_interval = refresh_interval
+        self.refreshed = None
+
+    async def refresh(self):
+        """
+        Index the games and consoles updated since the last refresh, or the whole catalog
+        the first time or when the storage doesn't hold as many games as the index, and
+        clear the cache if any of them changed. Returns how many did.
+        """
+        since = self.refreshed - REFRESH_OVERLAP if self.refreshed else None
+        started = datetime.now(timezone.utc)
+        games, consoles, count = await asyncio.to_thread(self.read, since)
+        changed = self.apply(games, consoles)
+        if count != len(self.index):
+            # Games were deleted, e.g. the catalog was cleared, or saved with an older
+            # UpdatedAt, e.g. imported from a snapshot: read the whole catalog again
+            if count < len(self.index):
+                self.index = GameIndex(self.index.min_similarity)
+                self.consoles = {}
+                self.cache.clear()
+            games, consoles, count = await asyncio.to_thread(self.read, None)
+            changed += self.apply(games, consoles)
+        self.refreshed = started
+
+        if changed:
+            self.cache.clear()
+        if changed and since:
+            logger.info("Indexed %d changed games and consoles, %d games in the index.",
+                        changed, len(self.index.games))
+        return changed
+
+    def apply(self, games, consoles):
+        changed = sum(self.index.add(game) for game in games)
+        for console in consoles:
+            if self.consoles.get(console['name']) != console:
+                self.consoles[console['name']] = console
+                changed += 1
+        return changed
+
+    def read(self, since):
+        games = list(self.storage.get_documents('games', since, LOCAL_FIELDS))
+        consoles = list(self.storage.get_documents('consoles', since))
+        return games, consoles, self.storage.count('games')
+
+    async def refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Keep answering from the index until the storage is back
+                logger.error("Error refreshing the search index: %s", e)
+
+    def search(self, query='', filters=None, limit=20, offset=0):
+        """
+        Search the index, or get the result from the cache. Returns (total, games).
+        """
+        start = time.perf_counter()
+        key = (normalize(query), tuple(sorted((name, filter_value(value))
+                                              for name, value in (filters or {}).items())),
+               limit, offset)
+        result = self.cache.get(key)
+        if result is not None:
+            self.cache.move_to_end(key)
+            cache = 'hit'
+        else:
+            result = self.cache[key] = self.index.search(query, filters, limit, offset)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            cache = 'miss'
+        SEARCHES.inc(cache=cache)
+        SEARCH_SECONDS.observe(time.perf_counter() - start, cache=cache)
+        return result
+
+    def application(self):
+        app = web.Application()
+        app.router.add_get('/games', self.serve_search)
+        app.router.add_get('/games/{name}', self.serve_game)
+        app.router.add_get('/consoles', self.serve_consoles)
+        return app
+
+    async def serve_search(self, request):
+        """
+        GET /games?q=<title>&console=&region=&year=&downloadable=true&limit=20&offset=0
+        """
+        try:
+            limit = min(int(request.query.get('limit', 20)), MAX_LIMIT)
+            offset = int(request.query.get('offset', 0))
+        except ValueError:
+            raise web.HTTPBadRequest(text="limit and offset must be integers")
+        if limit < 0 or offset < 0:
+            raise web.HTTPBadRequest(text="limit and offset can't be negative")
+        filters = {name: request.query[name] for name in FILTERS if name in request.query}
+
+        start = time.perf_counter()
+        total, games = self.search(request.query.get('q', ''), filters, limit, offset)
+        return web.json_response({'total': total, 'games': games,
+                                  'took_ms': (time.perf_counter() - start) * 1000},
+                                 dumps=dumps)
+
+    async def serve_game(self, request):
+        game = self.index.games.get(request.match_info['name'])
+        if game is None:
+            raise web.HTTPNotFound(text="No game of that name in the catalog")
+        return web.json_response(game, dumps=dumps)
+
+    async def serve_consoles(self, request):
+        consoles = [{**console, 'games': self.index.count('Console', name)}
+                    for name, console in sorted(self.consoles.items())]
+        return web.json_response(consoles, dumps=dumps)
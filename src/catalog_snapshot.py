@@ -0,0 +1,226 @@
+"""
+Snapshots of the catalog, to seed a node without crawling the vault.
+
+A snapshot is a folder holding the consoles and the games as chunks of gzipped NDJSON (one
+JSON document per line, `chunk_size` documents per file), and a manifest.json listing the
+chunks, written last. The documents are streamed from the storage while the chunks are
+compressed on worker threads, so an export only holds a few chunks in memory. An import
+upserts the chunks in parallel, keyed like the crawl's writers, and keeps the UpdatedAt
+dates of the snapshot. An incremental export only holds the documents updated since a
+date, e.g. the creation date of the previous snapshot.
+
+The fields describing the download folder of a node (Download and Verification) are left
+out. mongodump archives, like the ones in the backup folder, can be imported as well.
+"""
+import gzip
+import json
+import logging
+import os
+import struct
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
+from src.storage import UpsertResult
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+MANIFEST = 'manifest.json'
+COMPRESS_LEVEL = 6
+
+# Key of the documents of each collection, as upserted by the crawl
+COLLECTION_KEYS = {'consoles': 'name', 'games': 'GameName'}
+# Fields of the games that describe the download folder of a node
+LOCAL_FIELDS = ('Download', 'Verification')
+
+# A mongodump archive starts with this number, and ends each of its sections with -1
+MONGODUMP_MAGIC = 0x8199e26d
+MONGODUMP_TERMINATOR = -1
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def encode(value):
+    """
+    Serialize the values JSON doesn't know, dates as ISO 8601 strings in UTC.
+    """
+    if isinstance(value, datetime):
+        # Dates read back from MongoDB are naive, in UTC
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc).isoformat()
+    return str(value)
+
+
+def decode(document):
+    if document.get('UpdatedAt'):
+        document['UpdatedAt'] = datetime.fromisoformat(document['UpdatedAt'])
+    return document
+
+
+def write_chunk(path, documents):
+    data = ''.join(json.dumps(document, default=encode) + '\n' for document in documents)
+    with open(path, 'wb') as file:
+        file.write(gzip.compress(data.encode(), COMPRESS_LEVEL))
+
+
+def read_chunk(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        return [decode(json.loads(line)) for line in file]
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as file:
+        manifest = json.load(file)
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unknown snapshot format in {path}: {manifest.get('format')!r}")
+    return manifest
+
+
+def add_result(total, result):
+    total.new += result.new
+    total.updated += result.updated
+    total.unchanged += result.unchanged
+    total.errors += result.errors or []
+
+
+def export_snapshot(storage, path, since=None, chunk_size=10000, workers=4):
+    """
+    Write the catalog, or the documents updated since a date, to a new snapshot folder.
+    Returns the manifest.
+    """
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        raise FileExistsError(f"{path} already holds a snapshot")
+    os.makedirs(path, exist_ok=True)
+
+    # Taken before reading, so the next incremental export has what changes meanwhile
+    created_at = datetime.now(timezone.utc)
+    manifest = {'format': SNAPSHOT_FORMAT, 'created_at': created_at.isoformat(),
+                'since': encode(since) if since else None, 'collections': {}}
+
+    with ThreadPoolExecutor(workers) as executor:
+        for collection, key in COLLECTION_KEYS.items():
+            chunks = []
+            count = 0
+            pending = deque()
+            documents = storage.get_documents(collection, since, LOCAL_FIELDS)
+            for chunk in batched(documents, chunk_size):
+                name = f'{collection}-{len(chunks):05d}.ndjson.gz'
+                pending.append(executor.submit(write_chunk, os.path.join(path, name), chunk))
+                chunks.append(name)
+                count += len(chunk)
+                # Read ahead of the compression by one chunk per worker at most
+                while len(pending) > workers:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+            manifest['collections'][collection] = {'key': key, 'documents': count,
+                                                   'chunks': chunks}
+
+    with open(os.path.join(path, MANIFEST + '.part'), 'w') as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(os.path.join(path, MANIFEST + '.part'), os.path.join(path, MANIFEST))
+    return manifest
+
+
+def import_snapshot(storage, path, workers=4):
+    """
+    Upsert the documents of a snapshot folder, and get an UpsertResult per collection.
+    """
+    manifest = read_manifest(path)
+
+    def import_chunk(collection, key, chunk):
+        return storage.upsert(collection, key, read_chunk(os.path.join(path, chunk)))
+
+    results = {}
+    with ThreadPoolExecutor(workers) as executor:
+        for collection, entry in manifest['collections'].items():
+            futures = [executor.submit(import_chunk, collection, entry['key'], chunk)
+                       for chunk in entry['chunks']]
+            results[collection] = UpsertResult()
+            for future in futures:
+                add_result(results[collection], future.result())
+    return results
+
+
+def read_mongodump(path):
+    """
+    Get the (collection, document) of the consoles and games of a gzipped mongodump
+    archive, without their _id and the fields of the node's download folder.
+    """
+    import bson
+
+    def read_document(file):
+        size = file.read(4)
+        if len(size) < 4:
+            return None
+        length, = struct.unpack('<i', size)
+        if length == MONGODUMP_TERMINATOR:
+            return MONGODUMP_TERMINATOR
+        return bson.decode(size + file.read(length - 4))
+
+    with gzip.open(path) as file:
+        if struct.unpack('<I', file.read(4))[0] != MONGODUMP_MAGIC:
+            raise ValueError(f"{path} is not a mongodump archive")
+        # The archive's header, then the metadata of every collection
+        read_document(file)
+        while read_document(file) != MONGODUMP_TERMINATOR:
+            pass
+
+        # Blocks of documents, each after the header of its collection
+        namespace = None
+        while (document := read_document(file)) is not None:
+            if document == MONGODUMP_TERMINATOR:
+                namespace = None
+            elif namespace is None:
+                namespace = document
+            elif namespace['collection'] in COLLECTION_KEYS:
+                for name in ('_id',) + LOCAL_FIELDS:
+                    document.pop(name, None)
+                yield namespace['collection'], document
+
+
+def import_mongodump(storage, path, chunk_size=10000, workers=4):
+    """
+    Upsert the consoles and games of a mongodump archive, and get an UpsertResult
+    per collection.
+    """
+    results = defaultdict(UpsertResult)
+    pending = deque()
+
+    def collect(future):
+        collection, result = future.result()
+        add_result(results[collection], result)
+
+    def upsert(collection, documents):
+        return collection, storage.upsert(collection, COLLECTION_KEYS[collection], documents)
+
+    with ThreadPoolExecutor(workers) as executor:
+        buffers = defaultdict(list)
+        for collection, document in read_mongodump(path):
+            buffers[collection].append(document)
+            if len(buffers[collection]) >= chunk_size:
+                pending.append(executor.submit(upsert, collection, buffers.pop(collection)))
+                while len(pending) > workers:
+                    collect(pending.popleft())
+        for collection, documents in buffers.items():
+            pending.append(executor.submit(upsert, collection, documents))
+        for future in pending:
+            collect(future)
+    return dict(results)
+
+
+def snapshot_date(value):
+    """
+    Get the date of an incremental export's --since: an ISO 8601 date, or the folder
+    of a previous snapshot, whose creation date is taken.
+    """
+    if os.path.isdir(value):
+        value = read_manifest(value)['created_at']
+    date = datetime.fromisoformat(value)
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
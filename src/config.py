@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 
@@ -5,5 +6,107 @@ class Config(BaseSettings):
     """
     Configuration class for the application.
     """
-    database_url: str
     download_path: str
+
+    # Storage of the crawled catalog: 'mongo' on the DATABASE_URL server,
+    # or 'sqlite' in a local file, for crawls without a database server
+    storage_backend: str = 'mongo'
+    database_url: Optional[str] = None
+    storage_path: str = '.cache/catalog.sqlite'
+
+    # Vimm's Lair vault and download server
+    vault_url: str = 'https://vimm.net/vault'
+    download_url: str = 'https://download2.vimm.net/'
+
+    # HTTP connection pool shared by the whole crawl
+    http_connection_limit: int = 100
+    http_limit_per_host: int = 10
+    http_dns_cache_ttl: int = 300
+    http_keepalive_timeout: float = 30.0
+    http_connect_timeout: float = 10.0
+    http_read_timeout: float = 60.0
+
+    # Adaptive concurrency per host, between the minimum and the host's limit below, and
+    # retries with exponential backoff. Pages slower than the latency target (seconds)
+    # make the crawl back off.
+    http_initial_concurrency: int = 2
+    http_min_concurrency: int = 1
+    http_retry_attempts: int = 5
+    http_backoff_base: float = 1.0
+    http_backoff_max: float = 60.0
+    http_latency_target: float = 5.0
+
+    # Crawl scheduler
+    crawl_concurrency: int = 20
+    crawl_per_host_concurrency: int = 10
+    # Share of the unchanged listing rows whose game page an incremental crawl still fetches
+    crawl_reverify_rate: float = 0.02
+
+    # Batched database writes
+    db_batch_size: int = 500
+    db_flush_interval: float = 2.0
+
+    # Catalog snapshots of run_catalog.py: documents per compressed chunk file, and threads
+    # compressing the chunks on export and reading and upserting them on import
+    snapshot_chunk_size: int = 10000
+    snapshot_workers: int = 4
+
+    # Worker processes parsing the pages (None: one per core, 0: parse in the event loop)
+    parse_workers: Optional[int] = None
+    # BeautifulSoup tree builder used by the parsers ('html.parser' or 'lxml')
+    parser_backend: str = 'html.parser'
+
+    # On-disk HTTP cache of the crawled pages (an empty path disables it)
+    http_cache_path: str = '.cache/http_cache.sqlite'
+    http_cache_max_size: int = 512 * 1024 * 1024
+
+    # Catalog search API of run_search.py: results kept in the LRU cache, seconds between
+    # reads of the games the crawl updated, and share of a query's trigrams a title must hold
+    search_port: int = 8090
+    search_cache_size: int = 1024
+    search_refresh_interval: float = 5.0
+    search_min_similarity: float = 0.5
+
+    # Persistent crawl frontier, used to resume an interrupted crawl
+    frontier_path: str = '.cache/frontier.sqlite'
+    frontier_checkpoint_interval: float = 5.0
+
+    # Work queue shared by the workers of run_worker.py: how long a claimed item is leased
+    # to its worker, how often the leases are renewed, how many times an item is tried,
+    # and how often an idle worker looks for new items. The worker id defaults to host-pid.
+    queue_lease: float = 60.0
+    queue_heartbeat_interval: float = 15.0
+    queue_max_attempts: int = 3
+    queue_poll_interval: float = 1.0
+    worker_id: Optional[str] = None
+
+    # Download engine (bandwidth limit in bytes per second, None for no limit)
+    download_parallel: int = 4
+    download_per_host: int = 4
+    download_bandwidth_limit: Optional[int] = None
+    download_order: str = 'size'
+    # Download writer: block size, preallocation and fsync policy ('never', 'end' or 'periodic')
+    download_chunk_size: int = 1024 * 1024
+    download_preallocate: bool = False
+    download_fsync: str = 'end'
+    download_fsync_bytes: int = 256 * 1024 * 1024
+    download_progress_interval: float = 1.0
+
+    # Verification of the downloaded archives, on worker processes (None: one per core,
+    # 0: on a thread), right after each download unless disabled. The images are also
+    # extracted under the extract path, when one is set, in folders named by the layout.
+    verify_downloads: bool = True
+    verify_workers: Optional[int] = None
+    extract_path: str = ''
+    extract_layout: str = '{console}/{game}'
+
+    # Logging, metrics and profiling. Metrics are served on the port when one is set,
+    # and summarized every interval seconds (0 disables it) to the log and the summary path
+    log_level: str = 'INFO'
+    metrics_port: Optional[int] = None
+    metrics_summary_interval: float = 60.0
+    metrics_summary_path: str = ''
+    # Share of the pages parsed under cProfile (and tracemalloc), with the stats saved to the path
+    profile_sample_rate: float = 0.0
+    profile_path: str = '.cache/profiles'
+    profile_memory: bool = False
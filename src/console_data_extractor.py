@@ -1,8 +1,16 @@
+import asyncio
+import logging
+import random
+import string
+from urllib.parse import urljoin
 from src.game_data_extractor import GameDataExtractor
-import aiohttp
 from bs4 import BeautifulSoup
-from mongoengine import Document, StringField, connect
-from src.config import Config
+from mongoengine import Document, StringField, IntField, DateTimeField
+from src.metrics import LISTING_ROWS
+from src.page_parser import parse_console_page, parse_game_links
+from src.records import ConsoleRecord
+
+logger = logging.getLogger(__name__)
 
 
 class ConsoleDataDocument(Document):
@@ -10,35 +18,71 @@ class ConsoleDataDocument(Document):
     url = StringField(required=True)
     year = StringField(required=False)
     type = StringField(required=True, choices=["Console", "Handheld"])
+    # Coverage of the last crawl that discovered the console's listing: the sections
+    # found on the console page, the listing pages crawled and the games they listed
+    listing_sections = IntField(required=False)
+    listing_pages = IntField(required=False)
+    listed_games = IntField(required=False)
+    # Set by the storage whenever the console changes, for incremental exports
+    UpdatedAt = DateTimeField(required=False)
 
     meta = {
         'collection': 'consoles',
         'indexes': [
             'name',
+            'UpdatedAt',
         ]
     }
 
 
-config = Config()
-connect('game_database', host=config.database_url)
+# Sections of a console's listing, used when its page has no navigation
+LISTING_SECTIONS = '#' + string.ascii_uppercase
 
 
 class ConsoleDataExtractor:
-    def __init__(self, url):
+    def __init__(self, url, fetcher, scheduler, parse_pool, storage, console_writer,
+                 game_writer, consoles=None, letters=None, incremental=False,
+                 reverify_rate=0.0):
+        """
+        Initializes the extractor with the vault URL, the fetcher for the crawled pages,
+        the scheduler that runs the listing and game pages, the pool that parses
+        them, the storage of the catalog and the writers that save the consoles and
+        games to it.
+
+        `consoles` (names or URL slugs) and `letters` restrict the crawl to some consoles
+        and listing pages. In `incremental` mode, only the game pages whose listing row is
+        new or changed since the last crawl are fetched, plus a `reverify_rate` share of
+        the others picked at random.
+        """
         self.url = url
+        self.fetcher = fetcher
+        self.scheduler = scheduler
+        self.parse_pool = parse_pool
+        self.storage = storage
+        self.console_writer = console_writer
+        self.game_writer = game_writer
+        self.consoles = {console.lower() for console in consoles} if consoles else None
+        self.letters = letters
+        self.incremental = incremental
+        self.reverify_rate = reverify_rate
+        # Listing coverage of the consoles whose sections were discovered by this crawl
+        self.listing_counts = {}
+        self.scheduler.register('console', self.discover_listings)
+        self.scheduler.register('listing', self.extract_games_from_page)
+        self.scheduler.register('game', self.extract_game)
 
     async def request_site(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.url) as response:
-                content = await response.read()
-                consoles_data = self.extract_data(content)
-                # Save the extracted data to MongoDB
-                self.save_to_mongodb(consoles_data)
+        page = await self.fetcher.fetch(self.url, defer=True)
+
+        consoles_data = self.extract_data(page.content)
+        # Save the extracted data, unless the vault page is the same as last crawl
+        if page.changed:
+            await self.save_to_mongodb(consoles_data, page.commit)
 
-                # Process the console games
-                await self.process_console_games(consoles_data)
+        # Process the console games
+        await self.process_console_games(consoles_data)
 
-                return consoles_data
+        return consoles_data
 
     def extract_data(self, content):
         """
@@ -70,133 +114,164 @@ class ConsoleDataExtractor:
                     console_url = link_tag['href']
 
                     # Update the console URL if it's a relative URL
-                    if console_url.startswith("/"):
-                        console_url = f'https://vimm.net{console_url}'
+                    console_url = urljoin(self.url, console_url)
 
                     # Try to extract the year tag if it exists
                     year_tag = cols[1].text.strip() if len(cols) > 1 else None
 
-                    # Create a ConsoleDataDocument object and save it to MongoDB
-                    console = ConsoleDataDocument(
-                        name=console_name,
-                        url=console_url,
-                        year=year_tag,
-                        type=console_type
-                    )
-                    console.save()
-                    links.append({'name': console_name, 'url': console_url,
-                                 'year': year_tag, 'type': console_type})
+                    links.append(ConsoleRecord(console_name, console_url, year_tag, console_type))
 
         return links
 
     async def process_console_games(self, consoles_data):
         """
-        Process the games for each console and handheld by visiting the console's or handheld's page
-        and extracting game data.
-        """
-        # Process consoles
-        for console_data in consoles_data[0]:  # Consoles
-            console_url = console_data['url']
-            console_name = console_data['name']
-            print(
-                f"Processing games for console: {console_name} at {console_url}")
-
-            # Extract the games from the console page
-            await self.extract_games_from_page(console_url)
-
-            # Extract the games from the console page by letter
-            for letter in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
-                page_url = f'{console_url}/{letter}'
-                await self.extract_games_from_page(page_url)
-
-        # Process handhelds
-        for handheld_data in consoles_data[1]:  # Handhelds
-            handheld_url = handheld_data['url']
-            handheld_name = handheld_data['name']
-            print(
-                f"Processing games for handheld: {handheld_name} at {handheld_url}")
-
-            # Extract the games from the handheld page
-            await self.extract_games_from_page(handheld_url)
-
-            # Extract the games from the handheld page by letter
-            for letter in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
-                page_url = f'{handheld_url}/{letter}'
-                await self.extract_games_from_page(page_url)
-
-    async def extract_games_from_page(self, page_url):
-        """
-        Extract the games from the given page URL.
-        """
-        async with aiohttp.ClientSession() as session:
-            async with session.get(page_url) as response:
-                content = await response.read()
-                soup = BeautifulSoup(content, 'html.parser')
-
-                # Search for the game links on the page
-                game_links = self.extract_game_links(soup)
-
-                for game_link in game_links:
-                    game_url = f'https://vimm.net{game_link["url"]}'
-                    # Call the GameDataExtractor to extract the game data
-                    game_data_extractor = GameDataExtractor(game_url)
-                    await game_data_extractor.request_site()
-
-    def extract_game_links(self, soup):
-        """
-        Extract the links for all games on the console page.
-        """
-        game_links = []
-        game_table = soup.find(
-            'table', {'class': 'rounded centered cellpadding1 hovertable striped'})
-        if game_table:
-            rows = game_table.find_all('tr')
-            for row in rows:
-                cols = row.find_all('td')
-                if len(cols) > 1:
-                    link_tag = cols[0].find('a')
-                    if link_tag:
-                        game_name = link_tag.text.strip()
-                        game_url = link_tag['href']
-                        game_links.append({'name': game_name, 'url': game_url})
-
-        return game_links
-
-    def save_to_mongodb(self, consoles_data):
-        """
-        Save or update the extracted console data to MongoDB using the ConsoleDataDocument model.
-        If a console with the same name already exists, it will be updated with the new data.
-        """
-        try:
-            # Consoles If the console already exists in the database, update the data
-            for console_data in consoles_data[0]:
-                existing_console = ConsoleDataDocument.objects(
-                    name=console_data['name']).first()
-
-                if existing_console:
-                    existing_console.update(**console_data)
-                    print(
-                        f"Console data for '{console_data['name']}' updated in MongoDB.")
-                else:
-                    console_doc = ConsoleDataDocument(**console_data)
-                    console_doc.save()
-                    print(
-                        f"Console data saved to MongoDB: {console_data['name']}")
-
-            # Handhelds If the handheld already exists in the database, update the data
-            for handheld_data in consoles_data[1]:
-                existing_handheld = ConsoleDataDocument.objects(
-                    name=handheld_data['name']).first()
-
-                if existing_handheld:
-                    existing_handheld.update(**handheld_data)
-                    print(
-                        f"Handheld data for '{handheld_data['name']}' updated in MongoDB.")
-                else:
-                    handheld_doc = ConsoleDataDocument(**handheld_data)
-                    handheld_doc.save()
-                    print(
-                        f"Handheld data saved to MongoDB: {handheld_data['name']}")
-
-        except Exception as e:
-            print(f"Error saving console data: {e}")
+        Process the games for each console and handheld by scheduling the console's or
+        handheld's listing pages and the game pages they link to.
+        """
+        for console_data in consoles_data[0] + consoles_data[1]:
+            console_url = console_data.url
+            console_name = console_data.name
+            if not self.is_selected(console_data):
+                continue
+            logger.info("Processing games for %s: %s at %s",
+                        console_data.type.lower(), console_name, console_url)
+
+            # Schedule the console page, which discovers the listing pages. When only some
+            # letters are crawled, their pages are scheduled directly instead.
+            if self.letters:
+                for letter in self.letters:
+                    self.scheduler.enqueue(
+                        'listing', self.section_url(console_url, letter), console_name)
+            else:
+                self.scheduler.enqueue('console', console_url, console_name)
+
+        await self.scheduler.run()
+        # The workers of a shared crawl each see only some of a console's listing pages
+        if not self.scheduler.shared:
+            await self.save_listing_counts(consoles_data)
+
+    def is_selected(self, console_data):
+        """
+        Check if the console is one of the consoles to crawl, by name or URL slug.
+        """
+        if self.consoles is None:
+            return True
+        slug = console_data.url.rstrip('/').rsplit('/', 1)[-1]
+        return console_data.name.lower() in self.consoles or slug.lower() in self.consoles
+
+    @staticmethod
+    def section_url(console_url, section):
+        """
+        Get the URL of a section of the console's listing: a letter, or '#' for the
+        titles starting with a number or a symbol.
+        """
+        if section == '#':
+            slug = console_url.rstrip('/').rsplit('/', 1)[-1]
+            return urljoin(console_url, f'./?p=list&system={slug}&section=number')
+        return f'{console_url}/{section}'
+
+    async def discover_listings(self, console_url, console_name):
+        """
+        Schedule the listing pages linked from the console page's section navigation,
+        and the games listed on the console page itself.
+
+        Only the sections holding games are linked, so the empty letters are never fetched.
+        A console page without navigation falls back to every letter and '#'.
+        """
+        page = await self.fetcher.fetch(console_url)
+        console_page = await self.parse_pool.parse(parse_console_page, page.content)
+
+        section_urls = [urljoin(console_url, section['url'])
+                        for section in console_page['sections']]
+        if not section_urls:
+            logger.warning("No listing sections found on %s, trying every letter.", console_url)
+            section_urls = [self.section_url(console_url, section)
+                            for section in LISTING_SECTIONS]
+
+        self.listing_counts[console_name] = {
+            'listing_sections': len(section_urls), 'listing_pages': 0, 'listed_games': 0}
+        logger.info("Found %d listing sections for %s.", len(section_urls), console_name)
+        for section_url in section_urls:
+            self.scheduler.enqueue('listing', section_url, console_name)
+
+        await self.schedule_games(console_page['games'], console_url, console_name)
+
+    async def extract_games_from_page(self, page_url, console_name):
+        """
+        Extract the games from the given page URL and schedule their game pages.
+        """
+        page = await self.fetcher.fetch(page_url)
+
+        # Search for the game links on the page. An unchanged listing is still parsed,
+        # since the game pages it links to may have changed.
+        game_links = await self.parse_pool.parse(parse_game_links, page.content)
+        await self.schedule_games(game_links, page_url, console_name)
+
+    async def schedule_games(self, game_links, page_url, console_name):
+        """
+        Schedule the game pages of the links found on a listing page.
+        """
+        for game_link in game_links:
+            game_link.url = urljoin(page_url, game_link.url)
+
+        counts = self.listing_counts.get(console_name)
+        if counts:
+            counts['listing_pages'] += 1
+            counts['listed_games'] += len(game_links)
+
+        # Compare the listing rows with the ones saved by the last crawl
+        saved_signatures = await asyncio.to_thread(
+            self.storage.get_listing_signatures, [game_link.url for game_link in game_links])
+
+        for game_link in game_links:
+            game_url = game_link.url
+            saved_signature = saved_signatures.get(game_url)
+            # A new or changed row's signature is saved with its game
+            options = {}
+            if saved_signature != game_link.signature:
+                options['listing_signature'] = game_link.signature
+                result = 'new' if saved_signature is None else 'changed'
+            elif not self.incremental:
+                result = 'unchanged'
+            elif random.random() < self.reverify_rate:
+                result = 'reverified'
+            else:
+                LISTING_ROWS.inc(console=console_name, result='skipped')
+                continue
+
+            LISTING_ROWS.inc(console=console_name, result=result)
+            self.scheduler.enqueue('game', game_url, console_name, **options)
+
+    async def extract_game(self, game_url, console_name, listing_signature=None):
+        """
+        Extract the game data from the given game page URL.
+        """
+        # Call the GameDataExtractor to extract the game data
+        game_data_extractor = GameDataExtractor(
+            game_url, self.fetcher, self.parse_pool, self.game_writer, listing_signature)
+        await game_data_extractor.request_site()
+
+    async def save_listing_counts(self, consoles_data):
+        """
+        Save the listing coverage of the consoles discovered by this crawl.
+        """
+        for console_data in consoles_data[0] + consoles_data[1]:
+            counts = self.listing_counts.get(console_data.name)
+            if counts:
+                logger.info(
+                    "Listing of %s: %d sections, %d pages crawled, %d games listed.",
+                    console_data.name, counts['listing_sections'],
+                    counts['listing_pages'], counts['listed_games'])
+                await self.console_writer.add({'name': console_data.name, **counts})
+
+    async def save_to_mongodb(self, consoles_data, saved=None):
+        """
+        Save or update the extracted console data in the storage, calling `saved` once
+        they all are. Consoles are upserted by name, so an existing console is updated
+        with the new data.
+        """
+        consoles = consoles_data[0] + consoles_data[1]
+        for index, console_data in enumerate(consoles):
+            # The writer saves the records in order, the last one is saved after the others
+            await self.console_writer.add(
+                console_data, saved if index == len(consoles) - 1 else None)
@@ -0,0 +1,134 @@
+import json
+import os
+import sqlite3
+import time
+from src.crawl_scheduler import CrawlTask
+from src.storage import dumps
+
+
+class CrawlFrontier:
+    """
+    Persistent record of every crawl task, stored in a SQLite file.
+
+    Each URL is stored once with its state (pending, in_flight, done or failed) and the
+    options of its task, so a URL reached from several listing pages is crawled once, and
+    an interrupted crawl can resume from the tasks that were not done. Changes only become durable on
+    checkpoint(), which the scheduler calls every `checkpoint_interval` seconds. Finished
+    tasks are held in `done` and `failed` until a checkpoint marks them, as their records
+    may still be in the buffers of the writers.
+    """
+    PENDING = 'pending'
+    IN_FLIGHT = 'in_flight'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path, checkpoint_interval):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.checkpoint_interval = checkpoint_interval
+        self.done = []
+        self.failed = []
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                url TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                console TEXT NOT NULL,
+                options TEXT,
+                state TEXT NOT NULL,
+                error TEXT,
+                updated_at REAL
+            )''')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(tasks)')]
+        if 'options' not in columns:
+            # Frontiers written before the options were kept
+            self.connection.execute('ALTER TABLE tasks ADD COLUMN options TEXT')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)')
+        self.connection.commit()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def reset(self):
+        """
+        Forget every task, to start a new crawl from scratch.
+        """
+        self.connection.execute('DELETE FROM tasks')
+        self.connection.commit()
+
+    def resume(self):
+        """
+        Put the tasks an interrupted crawl left in flight or failed back to pending,
+        and return every pending task.
+        """
+        self.connection.execute(
+            'UPDATE tasks SET state = ?, updated_at = ? WHERE state IN (?, ?)',
+            (self.PENDING, time.time(), self.IN_FLIGHT, self.FAILED))
+        self.connection.commit()
+        rows = self.connection.execute(
+            'SELECT kind, url, console, options FROM tasks WHERE state = ? ORDER BY rowid',
+            (self.PENDING,))
+        return [CrawlTask(kind, url, console, json.loads(options) if options else {})
+                for kind, url, console, options in rows]
+
+    def add(self, task):
+        """
+        Add a pending task. Returns False if the URL is already known.
+        """
+        cursor = self.connection.execute(
+            'INSERT OR IGNORE INTO tasks (url, kind, console, options, state, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (task.url, task.kind, task.console, dumps(task.options), self.PENDING,
+             time.time()))
+        return cursor.rowcount == 1
+
+    def start(self, task):
+        self.set_state(task, self.IN_FLIGHT)
+
+    def complete(self, task):
+        self.done.append(task)
+
+    def fail(self, task, error):
+        self.failed.append((task, str(error)))
+
+    def set_state(self, task, state, error=None):
+        self.connection.execute(
+            'UPDATE tasks SET state = ?, error = ?, updated_at = ? WHERE url = ?',
+            (state, error, time.time(), task.url))
+
+    def counts(self):
+        """
+        Get the number of tasks in each state.
+        """
+        rows = self.connection.execute(
+            'SELECT state, COUNT(*) FROM tasks GROUP BY state')
+        return dict(rows.fetchall())
+
+    async def checkpoint(self, done=None, failed=None):
+        """
+        Mark the first `done` completed tasks done and the first `failed` failed tasks
+        failed, or all of them, and commit the changes.
+        """
+        done = len(self.done) if done is None else done
+        failed = len(self.failed) if failed is None else failed
+        for task in self.done[:done]:
+            self.set_state(task, self.DONE)
+        for task, error in self.failed[:failed]:
+            self.set_state(task, self.FAILED, error)
+        del self.done[:done]
+        del self.failed[:failed]
+        self.connection.commit()
+
+    def close(self):
+        # Only the tasks of the last checkpoint are finished, the others stay in flight
+        self.done.clear()
+        self.failed.clear()
+        self.connection.commit()
+        self.connection.close()
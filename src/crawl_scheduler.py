@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from urllib.parse import urlparse
+from src.metrics import current_console, PAGES, PAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CrawlTask:
+    kind: str
+    url: str
+    console: str
+    # Keyword arguments passed on to the handler
+    options: dict = field(default_factory=dict)
+
+
+@dataclass
+class ConsoleProgress:
+    name: str
+    pending: int = 0
+    listings: int = 0
+    games: int = 0
+    downloads: int = 0
+    failed: int = 0
+
+
+class CrawlScheduler:
+    """
+    Runs the crawl tasks (console, listing and game pages) on a pool of workers.
+
+    The number of workers is the global concurrency limit; a semaphore per host
+    caps how many of them may hit the same host at once. Tasks are recorded in the
+    frontier, which drops URLs already seen and keeps the state of every task.
+    """
+    # Whether other processes run tasks of the same crawl
+    shared = False
+
+    def __init__(self, concurrency, per_host_concurrency, frontier, writers=()):
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.frontier = frontier
+        self.writers = writers
+        self.checkpoint_lock = asyncio.Lock()
+        self.handlers = {}
+        self.queue = asyncio.Queue()
+        self.host_limits = {}
+        self.progress = {}
+
+    def register(self, kind, handler):
+        """
+        Register the coroutine that processes tasks of the given kind.
+        The handler is called with the task URL and console name, and the task's options
+        as keyword arguments.
+        """
+        self.handlers[kind] = handler
+
+    def enqueue(self, kind, url, console, **options):
+        """
+        Add a task to the queue, unless its URL was already queued or crawled.
+        """
+        task = CrawlTask(kind, url, console, options)
+        if self.frontier.add(task):
+            self.schedule(task)
+
+    def resume(self):
+        """
+        Queue the tasks an interrupted crawl did not finish.
+        """
+        tasks = self.frontier.resume()
+        for task in tasks:
+            self.schedule(task)
+        logger.info("Resuming crawl with %d pending pages.", len(tasks))
+
+    def schedule(self, task):
+        progress = self.progress.setdefault(
+            task.console, ConsoleProgress(task.console))
+        progress.pending += 1
+        self.queue.put_nowait(task)
+
+    async def run(self):
+        """
+        Process the queued tasks, and the tasks they enqueue, until none are left.
+        """
+        workers = [asyncio.create_task(self.worker())
+                   for _ in range(self.concurrency)]
+        workers.append(asyncio.create_task(self.checkpoint_periodically()))
+        try:
+            await self.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self.checkpoint()
+
+    async def worker(self):
+        while True:
+            task = await self.queue.get()
+            try:
+                await self.process(task)
+            finally:
+                self.queue.task_done()
+
+    async def process(self, task):
+        progress = self.progress[task.console]
+        # Everything the handler measures is labelled with the task's console
+        current_console.set(task.console)
+        self.frontier.start(task)
+        start = time.perf_counter()
+        try:
+            async with self.host_limit(task.url):
+                await self.handlers[task.kind](task.url, task.console, **task.options)
+        except Exception as e:
+            progress.failed += 1
+            self.frontier.fail(task, e)
+            PAGES.inc(console=task.console, kind=task.kind, outcome='failed')
+            logger.error("Error processing %s page %s: %s", task.kind, task.url, e)
+        else:
+            self.frontier.complete(task)
+            PAGES.inc(console=task.console, kind=task.kind, outcome='done')
+            PAGE_SECONDS.observe(time.perf_counter() - start,
+                                 console=task.console, kind=task.kind)
+            if task.kind == 'game':
+                progress.games += 1
+            elif task.kind == 'download':
+                progress.downloads += 1
+            else:
+                progress.listings += 1
+        finally:
+            progress.pending -= 1
+            if progress.pending == 0:
+                self.report(progress)
+
+    async def checkpoint_periodically(self):
+        while True:
+            await asyncio.sleep(self.frontier.checkpoint_interval)
+            try:
+                await self.checkpoint()
+            except Exception as e:
+                # The tasks stay unmarked, the next checkpoint tries again
+                logger.error("Error saving the crawl checkpoint: %s", e)
+
+    async def checkpoint(self):
+        """
+        Commit the frontier once the writers have saved the records of the tasks done so far,
+        so a resumed crawl never skips a page whose record was still in a writer buffer.
+        """
+        async with self.checkpoint_lock:
+            # Tasks finished during the flush may have records left in the buffers,
+            # they are marked by the next checkpoint
+            done, failed = len(self.frontier.done), len(self.frontier.failed)
+            for writer in self.writers:
+                await writer.flush()
+            await self.frontier.checkpoint(done, failed)
+
+    def host_limit(self, url):
+        """
+        Get the semaphore limiting the concurrent requests to the URL's host.
+        """
+        host = urlparse(url).netloc
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(
+                self.per_host_concurrency)
+        return self.host_limits[host]
+
+    def report(self, progress):
+        logger.info(
+            "Finished %s: %d listing pages, %d games, %d downloads, %d failed",
+            progress.name, progress.listings, progress.games, progress.downloads,
+            progress.failed)
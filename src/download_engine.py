@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import os
+import re
+import time
+import zipfile
+import zlib
+from dataclasses import dataclass, field
+from tqdm import tqdm
+from src.download_writer import DownloadWriter
+from src.metrics import current_console, DOWNLOAD_BYTES, DOWNLOAD_SECONDS, DOWNLOADS
+from src.rate_control import check_status, TransientError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DownloadJob:
+    name: str
+    url: str
+    save_path: str
+    headers: dict = field(default_factory=dict)
+    size: int = 0
+    game_id: object = None
+
+    @property
+    def part_path(self):
+        """
+        Where the download is written until it is complete and verified.
+        """
+        return self.save_path + '.part'
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by every transfer, capping the combined download rate
+    at `rate` bytes per second.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def consume(self, amount):
+        """
+        Wait until `amount` bytes fit in the bandwidth ceiling.
+        """
+        async with self.lock:
+            now = time.monotonic()
+            self.allowance = min(
+                self.rate, self.allowance + (now - self.updated) * self.rate)
+            self.updated = now
+            self.allowance -= amount
+            if self.allowance < 0:
+                # Holding the lock while sleeping makes every transfer wait its turn
+                await asyncio.sleep(-self.allowance / self.rate)
+
+
+class DownloadProgress:
+    """
+    A single progress bar for every transfer of a run.
+
+    Transfers report the bytes they receive, and the bar is redrawn at most every
+    `interval` seconds, however many transfers feed it.
+    """
+
+    def __init__(self, total_size, interval):
+        self.interval = interval
+        self.bar = tqdm(desc="Downloading", total=total_size or None, unit="B",
+                        unit_scale=True, unit_divisor=1024, ncols=100,
+                        mininterval=interval)
+        self.started = time.monotonic()
+        self.updated = self.started
+        self.pending = 0
+        self.transferred = 0
+        self.files = 0
+
+    def resize(self, estimate, size):
+        """
+        Replace a job's estimated size with the number of bytes it will really transfer.
+        """
+        if self.bar.total is not None:
+            self.bar.total = max(self.bar.total + size - estimate, 0)
+
+    def update(self, amount):
+        self.pending += amount
+        self.transferred += amount
+        now = time.monotonic()
+        if now - self.updated >= self.interval:
+            self.bar.update(self.pending)
+            self.pending = 0
+            self.updated = now
+
+    def file_done(self):
+        self.files += 1
+        self.bar.set_postfix(files=self.files, refresh=False)
+
+    def close(self):
+        self.bar.update(self.pending)
+        self.bar.close()
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        logger.info(
+            "Downloaded %.1f MB in %.1f s (%.1f MB/s).", self.transferred / 1024 ** 2,
+            elapsed, self.transferred / 1024 ** 2 / elapsed)
+
+
+class DownloadEngine:
+    """
+    Downloads jobs with aiohttp, in the order they are given.
+
+    `parallel` transfers run at the same time and share the optional bandwidth ceiling.
+    The rate controller adapts how many of them run against the same host, and retries
+    a transfer that is throttled or interrupted from where it stopped. Every transfer
+    writes through a DownloadWriter with the given block size, preallocation and fsync
+    policy, and reports to one progress bar for the whole run.
+
+    When a tracker is given, its started(job), done(job, size, checksum) and
+    failed(job, error) coroutines are awaited as every job goes through the engine.
+
+    When a verifier (src.archive_verifier.ArchiveVerifier, without `remove_corrupt`, as the
+    engine decides which corrupt archives to delete) is given, every downloaded
+    archive is verified by it instead of being tested here, so its files are read once,
+    in the background while the next downloads go on. Either way an archive stays a .part
+    file, and isn't done, until it is verified.
+    """
+
+    def __init__(self, session, parallel, controller, bandwidth_limit=None,
+                 chunk_size=1024 * 1024, preallocate=False, fsync='end', fsync_bytes=0,
+                 progress_interval=1.0, tracker=None, verifier=None):
+        self.session = session
+        self.parallel = parallel
+        self.controller = controller
+        self.bandwidth = BandwidthLimiter(
+            bandwidth_limit) if bandwidth_limit else None
+        self.chunk_size = chunk_size
+        self.preallocate = preallocate
+        self.fsync = fsync
+        self.fsync_bytes = fsync_bytes
+        self.progress_interval = progress_interval
+        self.tracker = tracker
+        self.verifier = verifier
+        self.progress = None
+        # Downloads being verified in the background
+        self.finishing = []
+
+    async def run(self, jobs):
+        """
+        Download every job, returning the number of jobs that failed.
+        """
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        self.open_progress(sum(job.size for job in jobs))
+        try:
+            results = await asyncio.gather(
+                *(self.worker(queue) for _ in range(self.parallel)))
+            finishing, self.finishing = self.finishing, []
+            finished = await asyncio.gather(*finishing)
+        finally:
+            self.close_progress()
+        return sum(results) + finished.count(False)
+
+    def open_progress(self, total_size=0):
+        """
+        Start the progress bar of the downloads to come, when they are not given to run().
+        """
+        self.progress = DownloadProgress(total_size, self.progress_interval)
+
+    def close_progress(self):
+        self.progress.close()
+
+    async def worker(self, queue):
+        failed = 0
+        while not queue.empty():
+            job = queue.get_nowait()
+            if not await self.download(job):
+                failed += 1
+        return failed
+
+    async def download(self, job, await_verification=False):
+        """
+        Download the job to its .part file, resuming a previous attempt, and move it to
+        its save path once it is verified. Returns False if the download failed.
+
+        With a verifier, the archive is verified in the background and run() waits for it
+        before returning, unless `await_verification` is set.
+        """
+        start = time.perf_counter()
+        try:
+            if self.tracker:
+                await self.tracker.started(job)
+            complete, checksum = await self.controller.call(
+                job.url, lambda: self.transfer(job))
+        except Exception as e:
+            await self.failed(job, e)
+            return False
+
+        if self.verifier and not await_verification:
+            self.finishing.append(asyncio.create_task(
+                self.finish(job, complete, checksum, start)))
+            return True
+        return await self.finish(job, complete, checksum, start)
+
+    async def finish(self, job, complete, checksum, start):
+        """
+        Verify the downloaded archive, then move it to its save path and mark it done.
+        Returns False if it failed verification.
+        """
+        console = current_console.get()
+        try:
+            if self.verifier:
+                await self.verify_archive(job, complete)
+            elif job.save_path.endswith('.zip'):
+                await asyncio.to_thread(self.verify, job, complete)
+            os.replace(job.part_path, job.save_path)
+            if self.tracker:
+                await self.tracker.done(job, os.path.getsize(job.save_path), checksum)
+
+            self.progress.file_done()
+            DOWNLOADS.inc(console=console, outcome='done')
+            DOWNLOAD_SECONDS.observe(time.perf_counter() - start, console=console)
+            logger.info("Download of %s completed successfully.", job.name)
+            return True
+        except Exception as e:
+            await self.failed(job, e)
+            return False
+
+    async def failed(self, job, error):
+        DOWNLOADS.inc(console=current_console.get(), outcome='failed')
+        logger.error("Error downloading %s: %s", job.name, error)
+        if self.tracker:
+            await self.tracker.failed(job, error)
+
+    async def transfer(self, job):
+        """
+        Stream the job's URL to its .part file, asking only for the missing bytes if a
+        previous attempt left one. Returns whether the file is known to hold every byte,
+        and its SHA-1.
+        """
+        writer = DownloadWriter(job.part_path, self.chunk_size, self.preallocate,
+                                self.fsync, self.fsync_bytes)
+        offset = writer.resume_offset()
+        headers = dict(job.headers)
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+
+        async with self.session.get(job.url, headers=headers) as response:
+            if response.status == 416:
+                # Nothing left after the offset, the .part file already holds the whole archive.
+                # Opening it hashes it, and closing it trims any preallocated space.
+                self.progress.resize(job.size, 0)
+                await writer.open(offset, 0)
+                await writer.close()
+                return True, writer.checksum
+            check_status(response)
+
+            if response.status == 206:
+                start, total_size = parse_content_range(
+                    response.headers.get('content-range'))
+                if start != offset:
+                    raise IOError(
+                        f"server resumed at byte {start} instead of {offset}")
+                logger.info("Resuming download of %s at byte %d...", job.name, offset)
+            else:
+                # The server ignored the Range header, start over
+                offset = 0
+                total_size = int(response.headers.get('content-length', 0))
+                logger.info("Starting download of %s...", job.name)
+
+            if total_size:
+                self.progress.resize(job.size, total_size - offset)
+                job.size = total_size - offset
+
+            await writer.open(offset, total_size)
+            console = current_console.get()
+            try:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    if self.bandwidth:
+                        await self.bandwidth.consume(len(chunk))
+                    await writer.write(chunk)
+                    self.progress.update(len(chunk))
+                    DOWNLOAD_BYTES.inc(len(chunk), console=console)
+            finally:
+                # Keep what was received, a later attempt resumes from there. The job's size
+                # becomes what the progress bar still expects from it.
+                await writer.close()
+                job.size = max(job.size - (writer.position - offset), 0)
+
+        if total_size and writer.position != total_size:
+            raise TransientError(
+                f"incomplete download, {writer.position} of {total_size} bytes received")
+        return bool(total_size), writer.checksum
+
+    async def verify_archive(self, job, complete):
+        """
+        Verify the .part file with the verifier. A corrupt archive that was fully received
+        is deleted, like in verify().
+        """
+        state = await self.verifier.verify(job.part_path, job.game_id)
+        if state['status'] == 'verified':
+            return
+        if state['status'] == 'corrupt' and complete:
+            await asyncio.to_thread(os.remove, job.part_path)
+        raise IOError(f"archive verification failed: {state['error']}")
+
+    def verify(self, job, complete):
+        """
+        Check the CRC of every file in the downloaded archive, when there is no verifier
+        to do it later.
+
+        A corrupt archive that was fully received is deleted, since resuming it can't fix it.
+        An archive of unknown length is kept, so the next attempt resumes it.
+        """
+        try:
+            with zipfile.ZipFile(job.part_path) as archive:
+                corrupt_file = archive.testzip()
+            if corrupt_file:
+                raise IOError(f"CRC check failed for {corrupt_file}")
+        except (IOError, zipfile.BadZipFile, zlib.error) as e:
+            if complete:
+                os.remove(job.part_path)
+            raise IOError(f"archive verification failed: {e}")
+
+
+def parse_content_range(content_range):
+    """
+    Get the first byte and the total size from a "bytes start-end/total" header.
+    The total is 0 when the server doesn't know it.
+    """
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', content_range or '')
+    if not match:
+        raise IOError(f"invalid Content-Range header: {content_range}")
+    total = match.group(2)
+    return int(match.group(1)), int(total) if total != '*' else 0
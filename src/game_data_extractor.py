@@ -1,11 +1,39 @@
-import aiohttp
-import base64
-from bs4 import BeautifulSoup
-from mongoengine import connect, Document, StringField, FloatField, BooleanField, DictField, NotUniqueError
-from src.config import Config
+from mongoengine import Document, EmbeddedDocument, EmbeddedDocumentField, \
+    StringField, FloatField, BooleanField, DictField, IntField, DateTimeField, ListField
+from src.page_parser import parse_game_page
 
-config = Config()
-connect('game_database', host=config.database_url)
+
+# States of a game's download. A game without a download state is pending.
+DOWNLOAD_STATUSES = ('pending', 'in_progress', 'done', 'failed')
+
+
+class DownloadState(EmbeddedDocument):
+    status = StringField(required=True, choices=DOWNLOAD_STATUSES, default='pending')
+    size = IntField(required=False)
+    checksum = StringField(required=False)  # SHA-1 of the downloaded file
+    error = StringField(required=False)
+    updated_at = DateTimeField(required=False)
+
+
+# Outcomes of an archive's verification
+VERIFICATION_STATUSES = ('verified', 'corrupt', 'failed')
+
+
+class ArchiveFile(EmbeddedDocument):
+    name = StringField(required=True)
+    size = IntField(required=True)
+    crc32 = StringField(required=True)
+    md5 = StringField(required=True)
+    sha1 = StringField(required=True)
+
+
+class VerificationState(EmbeddedDocument):
+    status = StringField(required=True, choices=VERIFICATION_STATUSES)
+    archive_size = IntField(required=False)  # Size of the archive the files were read from
+    files = ListField(EmbeddedDocumentField(ArchiveFile))
+    extracted_to = StringField(required=False)
+    error = StringField(required=False)
+    updated_at = DateTimeField(required=False)
 
 
 class GameDataDocument(Document):
@@ -25,11 +53,26 @@ class GameDataDocument(Document):
     DownloadURL = StringField(required=False)
     DownloadParams = DictField(required=False)
     DownloadSize = StringField(required=False)
+    # Game page, and the signature of its row in the console listing at the last crawl
+    URL = StringField(required=False)
+    ListingSignature = StringField(required=False)
+    # Set by the storage whenever the game changes, for incremental exports
+    UpdatedAt = DateTimeField(required=False)
+    # Written by the downloader, never by the crawl
+    Download = EmbeddedDocumentField(DownloadState, required=False)
+    # Written by the archive verifier: the hashes and sizes of the files in the archive
+    Verification = EmbeddedDocumentField(VerificationState, required=False)
 
     meta = {
         'collection': 'games',
         'indexes': [
             'GameName',
+            # Listing rows are compared with the catalog by game page
+            'URL',
+            # Download candidates are looked up by console, and only the pending ones
+            ('Console', 'CanBeDownloaded', 'Download.status'),
+            # Incremental exports read the games changed since a date
+            'UpdatedAt',
         ]
     }
 
@@ -58,165 +101,36 @@ class GameDataDocument(Document):
 
 
 class GameDataExtractor:
-    def __init__(self, url):
+    def __init__(self, url, fetcher, parse_pool, writer, listing_signature=None):
+        """
+        Initializes the extractor with the game URL, the fetcher for the crawled pages,
+        the pool that parses the page and the writer that saves the games.
+        A listing signature is given when the game's listing row changed, to be saved
+        with the game.
+        """
         self.url = url
+        self.fetcher = fetcher
+        self.parse_pool = parse_pool
+        self.writer = writer
+        self.listing_signature = listing_signature
 
     async def request_site(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.url) as response:
-                content = await response.read()
-                game_data = self.extract_data(content)
-                # Save the extracted data to MongoDB
-                self.save_to_mongodb(game_data)
-                return game_data
-
-    def extract_data(self, content):
-        """
-        Extracts the game data from the given HTML content.
-        """
-        soup = BeautifulSoup(content, 'html.parser')
-
-        # Extract game name and console name
-        console = soup.find('div', {'class': 'sectionTitle'})
-        game_name = None
-        console_name = None
-        if console:
-            console_name = console.text.strip()
-            canvas = console.find_next('canvas')
-            if canvas:
-                data_v_base64 = canvas['data-v']
-                game_name = base64.b64decode(data_v_base64).decode('utf-8')
-
-        # Verify if download is possible
-        download_form = soup.find('form', id='dl_form')
-        download_possible = bool(download_form)
-        download_url = None
-        download_params = {}
-        if download_possible:
-            download_url = download_form['action']
-            # Check if download_url starts with "//" and add "https:"
-            if download_url and download_url.startswith("//"):
-                download_url = "https:" + download_url
-
-            # Extract download form parameters
-            for input_tag in download_form.find_all('input'):
-                if input_tag.has_attr('name'):
-                    download_params[input_tag['name']
-                                    ] = input_tag.get('value', '')
-
-        # Extract table data (including format and size)
-        table_data = self.extract_table_data(soup)
-
-        # Extract download size and format (from the HTML)
-        download_size = self.extract_download_size(soup)
-        download_format = self.extract_download_format(soup)
-
-        # Save the extracted data to a GameDataDocument object
-        game_data = GameDataDocument(
-            Region=table_data.get('Region'),
-            Players=table_data.get('Players'),
-            Year=table_data.get('Year'),
-            Graphics=table_data.get('Graphics'),
-            Sound=table_data.get('Sound'),
-            Gameplay=table_data.get('Gameplay'),
-            Version=table_data.get('Version'),
-            GameName=game_name,
-            Console=console_name,
-            CanBeDownloaded=download_possible,
-            DownloadURL=download_url,
-            DownloadParams=download_params,
-            DownloadSize=download_size,
-            Format=download_format
-        )
+        # The page is only cached once the game is saved, as an unchanged page is skipped
+        page = await self.fetcher.fetch(self.url, defer=True)
+        if not page.changed and self.listing_signature is None:
+            # Same page and listing row as last crawl, there is nothing new to parse or save
+            return None
+
+        game_data = await self.parse_pool.parse(parse_game_page, page.content)
+        game_data.URL = self.url
+        game_data.ListingSignature = self.listing_signature
+        # Save the extracted data to the storage
+        await self.save_to_mongodb(game_data, page.commit)
         return game_data
 
-    def extract_table_data(self, soup):
-        """
-        Extracts the game data from the table in the HTML content.
-        """
-        table = soup.find('table', {'class': 'rounded cellpadding1'})
-        data = {}
-
-        if table:
-            rows = table.find_all('tr')
-            for row in rows:
-                cols = row.find_all('td')
-                if len(cols) == 3:
-                    key = cols[0].text.strip()
-                    value = cols[2].text.strip()
-                    if cols[2].find('img'):
-                        value = cols[2].img['title']
-
-                    key_map = {
-                        'Region': 'Region',
-                        'Players': 'Players',
-                        'Year': 'Year',
-                        'Graphics': 'Graphics',
-                        'Sound': 'Sound',
-                        'Gameplay': 'Gameplay',
-                        'Version': 'Version',
-                    }
-
-                    if key in key_map:
-                        if key == 'Version':
-                            value = value.split()[0]
-                        data[key_map[key]] = value
-
-                        if key in ['Graphics', 'Sound', 'Gameplay', 'Overall']:
-                            try:
-                                data[key_map[key]] = float(value.split()[0])
-                            except ValueError:
-                                pass  # TODO: Handle or log the error as necessary
-
-        return data
-
-    def extract_download_size(self, soup):
-        """
-        Extracts the download size from the HTML content.
-        """
-        try:
-            size_element = soup.find('td', id='dl_size')
-            if size_element:
-                return size_element.text.strip()
-        except Exception as e:
-            print(f"Error extracting download size: {e}")
-        return None
-
-    def extract_download_format(self, soup):
-        """
-        Extracts the download format (e.g., .wbfs, .rvz) from the HTML content.
-        """
-        try:
-            format_element = soup.find('select', id='dl_format')
-            if format_element:
-                selected_option = format_element.find('option', selected=True)
-                if selected_option:
-                    return selected_option.text.strip()
-        except Exception as e:
-            print(f"Error extracting download format: {e}")
-        return None
-
-    def save_to_mongodb(self, game_data):
+    async def save_to_mongodb(self, game_data, saved=None):
         """
-        Save or update the extracted game data to MongoDB using the GameDataDocument model.
-        If a game with the same GameName already exists, it will be updated with the new data.
+        Save or update the extracted game data in the storage, calling `saved` once it is.
+        Games are upserted by GameName, so an existing game is updated with the new data.
         """
-        try:
-            # Check if the game already exists in the database
-            existing_game = GameDataDocument.objects(
-                GameName=game_data.GameName).first()
-
-            if existing_game:
-                # Update the existing document with the new data
-                existing_game.update(**game_data.to_dict())
-                print(
-                    f"Game data for '{game_data.GameName}' updated in MongoDB.")
-            else:
-                # If the game does not exist, save the new document
-                game_doc = game_data
-                game_doc.save()
-                print(f"Game data saved to MongoDB: {game_data.GameName}")
-
-        except NotUniqueError:
-            print(
-                f"Duplicate GameName found: {game_data.GameName}. Skipping insert.")
+        await self.writer.add(game_data, saved)
@@ -1,113 +1,227 @@
-import requests
+import asyncio
+import logging
 import os
 import re
-from mongoengine import connect
-from src.config import Config
-from tqdm import tqdm
+from datetime import datetime, timezone
+from src.download_engine import DownloadJob
+from src.metrics import current_console
 
-config = Config()
-connect('game_database', host=config.database_url)
+logger = logging.getLogger(__name__)
+
+# Multipliers for the units used in the DownloadSize field, e.g. "1.3 GB"
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2,
+              'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+
+def parse_size(size):
+    """
+    Convert a download size like "700 MB" to bytes. Unknown sizes are 0.
+    """
+    match = re.match(r'\s*([\d.,]+)\s*([KMGT]?B)', size or '', re.IGNORECASE)
+    if not match:
+        return 0
+    return int(float(match.group(1).replace(',', '')) * SIZE_UNITS[match.group(2).upper()])
+
+
+def size_range(size):
+    """
+    Get the smallest and largest number of bytes a download size like "1.23 GB" may stand
+    for, or None when it is unknown. The size is rounded to its last digit, and its units
+    may be multiples of 1000 or of 1024.
+    """
+    match = re.match(r'\s*([\d,]+)(?:\.(\d+))?\s*([KMGT]?B)', size or '', re.IGNORECASE)
+    if not match:
+        return None
+    value = float(f"{match.group(1).replace(',', '')}.{match.group(2) or 0}")
+    step = 10 ** -len(match.group(2) or '')
+    power = 'BKMGT'.index(match.group(3).upper()[0])
+    return (max(value - step, 0) * 1000 ** power, (value + step) * 1024 ** power)
+
+
+def sanitize_filename(filename):
+    # Remove or replace problematic characters in the filename
+    return re.sub(r'[<>:"/\\|?*]', '_', filename)
+
+
+class DownloadStateTracker:
+    """
+    Records the state of every download on its game's document, as the engine goes.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def started(self, job):
+        await asyncio.to_thread(self.save, job, 'in_progress')
+
+    async def done(self, job, size, checksum):
+        await asyncio.to_thread(self.save, job, 'done', size=size, checksum=checksum)
+
+    async def failed(self, job, error):
+        await asyncio.to_thread(self.save, job, 'failed', error=str(error))
+
+    def save(self, job, status, **fields):
+        state = {'status': status, 'updated_at': datetime.now(timezone.utc), **fields}
+        self.storage.save_download_states([(job.game_id, state)])
 
 
 class GameDownloadChecker:
-    def __init__(self, console_data):
+    def __init__(self, console_data, engine, storage, config):
         """
-        Initializes the GameDownloadChecker object with the console data.
+        Initializes the GameDownloadChecker object with the console data, the engine
+        that downloads the games, the storage of the catalog and the configuration.
+        The games are downloaded in the `download_order` of the configuration: 'size'
+        for the smallest games first or 'catalog' for the storage order.
+
+        The console data is None for a checker that only downloads the games claimed
+        from a work queue.
         """
         self.console_data = console_data
+        self.engine = engine
+        self.storage = storage
+        self.config = config
+        self.order = config.download_order
 
-    async def check_downloadable_games(self):
+    async def check_downloadable_games(self, reconcile=False):
         """
-        Search for downloadable games for the console.
+        Search for the console's games that are not downloaded yet and download them.
+
+        The download folder is reconciled with the storage first when `reconcile` is set,
+        or when none of the console's games has a download state yet.
         """
         console_name = self.console_data['name']
+        jobs = [job for job, _ in await self.find_downloads(reconcile)]
 
-        print(
-            f"Checking downloadable games for console: {console_name}")
-
-        games = self.get_games_from_console(console_name)
+        failed = await self.engine.run(jobs)
+        logger.info("Downloaded %d of %d games for console: %s",
+                    len(jobs) - failed, len(jobs), console_name)
 
-        for game in games:
-            print(f"Checking game: {game['GameName']}")
-
-            if self.can_download_game(game):
-                print(f"Game {game['GameName']} is downloadable.")
-                self.download_game(game)
-            else:
-                print(f"Game {game['GameName']} is NOT downloadable.")
+    async def enqueue_downloadable_games(self, scheduler, reconcile=False):
+        """
+        Add the console's games that are not downloaded yet to the scheduler, as 'download'
+        tasks handled by download_game.
+        """
+        downloads = await self.find_downloads(reconcile)
+        for job, game in downloads:
+            scheduler.enqueue('download', job.url, self.console_data['name'], game=game)
+        logger.info("Queued %d games to download for console: %s",
+                    len(downloads), self.console_data['name'])
 
-    def get_games_from_console(self, console_name):
+    async def find_downloads(self, reconcile):
         """
-        Get games for the console from the database.
+        Get the (job, game) of every game of the console to download, in download order.
         """
-        from src.game_data_extractor import GameDataDocument
+        console_name = self.console_data['name']
+        # The downloads started from here are labelled with the console
+        current_console.set(console_name)
+
+        if reconcile or not await asyncio.to_thread(self.storage.has_download_state,
+                                                    console_name):
+            await asyncio.to_thread(self.reconcile, console_name)
 
-        games = GameDataDocument.objects(Console=console_name)
+        logger.info("Checking downloadable games for console: %s", console_name)
+        os.makedirs(os.path.join(self.config.download_path, console_name), exist_ok=True)
 
-        return [game.to_dict() for game in games]
+        downloads = await asyncio.to_thread(self.create_download_jobs, console_name)
+        if self.order == 'size':
+            downloads.sort(key=lambda download: download[0].size)
+        return downloads
+
+    def create_download_jobs(self, console_name):
+        """
+        Read the console's games that are not downloaded yet from the storage, and get
+        the (job, game) of those that can be downloaded.
+        """
+        downloads = []
+        for game in self.storage.get_downloadable_games(console_name):
+            logger.debug("Game %s is downloadable.", game['GameName'])
+            job = self.create_download_job(game)
+            if job:
+                downloads.append((job, game))
+        return downloads
+
+    async def download_game(self, url, console_name, game):
+        """
+        Download a game claimed from the work queue. A failed download raises,
+        so the game goes back to the queue. The archive is verified before the item is done,
+        so a corrupt one goes back to the queue as well.
+        """
+        job = self.create_download_job(game)
+        # The worker may run on a host that never saw the console
+        os.makedirs(os.path.dirname(job.save_path), exist_ok=True)
+        if not await self.engine.download(job, await_verification=True):
+            raise IOError(f"download of {job.name} failed")
 
-    def can_download_game(self, game):
+    def reconcile(self, console_name):
         """
-        Check if the game is downloadable.
+        Bring the download state of the console's games in line with its download folder,
+        listed in a single pass: games whose archive is there are done, and games marked
+        done whose archive is gone are pending again.
+
+        An archive whose size doesn't match the game's DownloadSize, e.g. one truncated by
+        an interrupted download, is failed instead of done, so it is downloaded again.
         """
-        if game.get('DownloadURL') and game.get('CanBeDownloaded'):
-            return True
-        return False
+        files = {}
+        directory = os.path.join(self.config.download_path, console_name)
+        if os.path.isdir(directory):
+            with os.scandir(directory) as entries:
+                files = {entry.name: entry.stat().st_size
+                         for entry in entries if entry.is_file()}
+
+        now = datetime.now(timezone.utc)
+        states = []
+        for game in self.storage.get_download_states(console_name):
+            done = game['status'] == 'done'
+            filename = self.sanitize_filename(f"{game['GameName']}.zip")
+            if filename in files and not done:
+                expected = size_range(game.get('DownloadSize'))
+                if expected and not expected[0] <= files[filename] <= expected[1]:
+                    if game['status'] == 'failed':
+                        continue
+                    state = {'status': 'failed', 'size': files[filename], 'updated_at': now,
+                             'error': f"archive of {files[filename]} bytes, "
+                                      f"{game['DownloadSize']} expected"}
+                else:
+                    state = {'status': 'done', 'size': files[filename], 'updated_at': now}
+            elif filename not in files and done:
+                state = {'status': 'pending', 'updated_at': now}
+            else:
+                continue
+            states.append((game['_id'], state))
+
+        self.storage.save_download_states(states)
+        logger.info("Reconciled %d games of %s with %d files in %s.",
+                    len(states), console_name, len(files), directory)
 
     def sanitize_filename(self, filename):
-        # Remove or replace problematic characters in the filename
-        return re.sub(r'[<>:"/\\|?*]', '_', filename)
+        return sanitize_filename(filename)
 
-    def download_game(self, game):
+    def create_download_job(self, game):
         """
-        Download the game from the download URL.
+        Create the job downloading the game from the download URL,
+        or None if the game can't be downloaded.
         """
         media_id = game.get('DownloadParams', {}).get('mediaId')
-        download_url = f"https://download2.vimm.net/?mediaId={media_id}"
+        download_url = f"{self.config.download_url}?mediaId={media_id}"
 
         if not media_id:
-            print(
-                f"Not possible to download {game['GameName']}. Missing mediaId.")
-            return
+            logger.warning("Not possible to download %s. Missing mediaId.", game['GameName'])
+            return None
 
         filename = self.sanitize_filename(
             f"{game['GameName']}.zip")  # Sanitize the filename
 
-        console_directory = os.path.join(config.download_path, game['Console'])
-        if not os.path.exists(console_directory):
-            os.makedirs(console_directory)
-
-        save_path = os.path.join(console_directory, filename)
-
-        if os.path.exists(save_path):
-            print(f"File {filename} already exists. Skipping download.")
-            return
+        save_path = os.path.join(self.config.download_path, game['Console'], filename)
 
+        # The archives are streamed as they are, so ask the server not to encode them
         headers = {
             'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
-            'Referer': f'https://vimm.net/vault/{game["Console"]}',
+            'Referer': f'{self.config.vault_url}/{game["Console"]}',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'Accept-Encoding': 'gzip, deflate, br, zstd',
+            'Accept-Encoding': 'identity',
             'Accept-Language': 'en-US,en;q=0.9,pt;q=0.8',
             'Connection': 'keep-alive',
         }
 
-        try:
-            print(f"Starting download of {filename}...")
-
-            response = requests.get(download_url, headers=headers, stream=True)
-            response.raise_for_status()
-
-            total_size = int(response.headers.get('content-length', 0))
-            with open(save_path, 'wb') as file:
-                for chunk in tqdm(response.iter_content(chunk_size=8192),
-                                  desc=f"Downloading: {filename}",
-                                  total=total_size // 8192,
-                                  unit="KB",
-                                  ncols=100):
-                    if chunk:
-                        file.write(chunk)
-
-            print(f"Download of {filename} completed successfully.")
-        except requests.exceptions.RequestException as e:
-            print(f"Error downloading {filename}: {e}")
+        return DownloadJob(filename, download_url, save_path, headers,
+                           parse_size(game.get('DownloadSize')), game['_id'])
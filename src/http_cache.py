@@ -0,0 +1,143 @@
+import asyncio
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from src.http_session import FetchedPage
+from src.rate_control import check_status
+
+
+class HttpCache:
+    """
+    On-disk cache of the crawled pages, stored in a SQLite file.
+
+    For every URL it keeps the ETag and Last-Modified headers, a hash of the body and the
+    compressed body. Cached URLs are fetched with conditional requests, and a 304 or a
+    body identical to the cached one is returned as unchanged. A fetch can leave the new
+    copy of the page to be cached by the caller, once it saved what it took from the page:
+    otherwise a crawl stopped in between would find the page unchanged, and never save
+    it. When the cached bodies
+    take more than `max_size` bytes, the least recently used pages are evicted.
+    """
+
+    def __init__(self, path, max_size):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                body BLOB,
+                size INTEGER,
+                accessed_at REAL
+            )''')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)')
+        self.size = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def fetch(self, session, url, defer=False):
+        """
+        Fetch the URL, revalidating the cached copy if there is one.
+        An error status raises, and nothing is cached.
+
+        With `defer`, a new or changed page is only cached when the `commit` of the returned
+        page is called, on any thread.
+        """
+        entry = await asyncio.to_thread(self.get, url)
+
+        headers = {}
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and entry:
+                await asyncio.to_thread(self.touch, url)
+                return FetchedPage(entry['content'], changed=False, status=304)
+
+            check_status(response)
+            content = await response.read()
+
+            content_hash = hashlib.sha1(content).hexdigest()
+            changed = not entry or entry['content_hash'] != content_hash
+            commit = functools.partial(
+                self.put, url, response.headers.get('ETag'),
+                response.headers.get('Last-Modified'), content_hash, content)
+            # An unchanged body is cached already, only its headers may be new
+            if not defer or not changed:
+                await asyncio.to_thread(commit)
+                commit = None
+
+        return FetchedPage(content, changed, commit=commit)
+
+    def get(self, url):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT etag, last_modified, content_hash, body FROM pages WHERE url = ?',
+                (url,)).fetchone()
+        if not row:
+            return None
+        return {
+            'etag': row[0],
+            'last_modified': row[1],
+            'content_hash': row[2],
+            'content': zlib.decompress(row[3]),
+        }
+
+    def touch(self, url):
+        with self.lock:
+            self.connection.execute(
+                'UPDATE pages SET accessed_at = ? WHERE url = ?', (time.time(), url))
+            self.connection.commit()
+
+    def put(self, url, etag, last_modified, content_hash, content):
+        body = zlib.compress(content)
+        with self.lock:
+            previous = self.connection.execute(
+                'SELECT size FROM pages WHERE url = ?', (url,)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, content_hash, body, len(body), time.time()))
+            self.size += len(body) - (previous[0] if previous else 0)
+            if self.size > self.max_size:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        """
+        Delete the least recently used pages until the cache is back under 90% of its size.
+        """
+        target = self.max_size * 0.9
+        rows = self.connection.execute(
+            'SELECT url, size FROM pages ORDER BY accessed_at')
+        evicted = []
+        for url, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((url,))
+            self.size -= size
+        self.connection.executemany('DELETE FROM pages WHERE url = ?', evicted)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
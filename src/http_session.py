@@ -0,0 +1,83 @@
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+import aiohttp
+from src.metrics import current_console, FETCH_BYTES, FETCH_REQUESTS, FETCH_SECONDS
+from src.rate_control import check_status, RetryableStatus
+
+
+def create_session(config):
+    """
+    Create the aiohttp session shared by the whole crawl.
+
+    A single connector keeps connections alive and caches DNS lookups, so every
+    request after the first one to a host reuses an open TLS connection.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=config.http_connection_limit,
+        limit_per_host=config.http_limit_per_host,
+        ttl_dns_cache=config.http_dns_cache_ttl,
+        keepalive_timeout=config.http_keepalive_timeout,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=None,
+        connect=config.http_connect_timeout,
+        sock_read=config.http_read_timeout,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+@dataclass
+class FetchedPage:
+    content: bytes
+    changed: bool = True
+    status: int = 200
+    # Caches the page, when the fetch deferred it to the caller
+    commit: Optional[Callable[[], None]] = None
+
+
+class PageFetcher:
+    """
+    Fetches the crawled pages through the shared session.
+
+    When an HTTP cache is given, pages are revalidated against it and `changed` tells
+    whether the page differs from the one fetched by the previous crawl.
+    When a rate controller is given, requests run under its adaptive limit and
+    throttled or failed requests are retried. An error status raises instead of
+    returning the error page.
+
+    A page fetched with `defer` is only cached once its `commit` is called. Callers that
+    skip unchanged pages defer, and commit when the records of the page are saved.
+    """
+
+    def __init__(self, session, cache=None, controller=None):
+        self.session = session
+        self.cache = cache
+        self.controller = controller
+
+    async def fetch(self, url, defer=False):
+        start = time.perf_counter()
+        if self.controller:
+            page = await self.controller.call(url, lambda: self.attempt(url, defer))
+        else:
+            page = await self.attempt(url, defer)
+
+        console = current_console.get()
+        FETCH_SECONDS.observe(time.perf_counter() - start, console=console)
+        FETCH_REQUESTS.inc(console=console, status=page.status)
+        if page.status != 304:
+            # A revalidated page comes from the cache, nothing was transferred
+            FETCH_BYTES.inc(len(page.content), console=console)
+        return page
+
+    async def attempt(self, url, defer=False):
+        try:
+            if self.cache:
+                return await self.cache.fetch(self.session, url, defer)
+
+            async with self.session.get(url) as response:
+                check_status(response)
+                return FetchedPage(await response.read(), status=response.status)
+        except (RetryableStatus, aiohttp.ClientResponseError) as e:
+            FETCH_REQUESTS.inc(console=current_console.get(), status=e.status)
+            raise
@@ -0,0 +1,296 @@
+"""
+Counters and latency histograms for every stage of the crawl and the downloads.
+
+The stages record into the module level metrics below, labelled by console, status code,
+collection or outcome. MetricsExporter serves them in the Prometheus text format and/or
+logs a JSON summary of them periodically, which tells whether a run is bound by the
+network, the parsers (CPU) or the database.
+
+The console of the work being measured is taken from the `current_console` context
+variable, which the crawl scheduler and the download checker set for their tasks.
+"""
+import asyncio
+import bisect
+import contextvars
+import json
+import logging
+import os
+from collections import defaultdict
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Console the current task works on, used as the console label
+current_console = contextvars.ContextVar('current_console', default='')
+
+# Upper bounds of the histogram buckets, in seconds or bytes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+DOWNLOAD_BUCKETS = (1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+MEMORY_BUCKETS = tuple(1024 * 2 ** exponent for exponent in range(6, 16))
+
+
+class Counter:
+    """
+    A value per label set that only goes up.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self.values[self.label_values(labels)] += amount
+
+    def label_values(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def samples(self):
+        """
+        Get the (name suffix, label values, extra labels, value) of every sample.
+        """
+        for values, value in sorted(self.values.items()):
+            yield '', values, (), value
+
+    def summary(self):
+        return {format_labels(self.labels, values): value
+                for values, value in sorted(self.values.items())}
+
+
+class Gauge(Counter):
+    """
+    A value per label set that is set to the latest measure.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.label_values(labels)] = value
+
+
+class Histogram(Counter):
+    """
+    Counts observations in cumulative buckets, and keeps their count and sum, per label set.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        series = self.values.get(key)
+        if series is None:
+            # One count per bucket plus +Inf, then the sum of the observations
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for values, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                yield '_bucket', values, (('le', str(bound)),), cumulative
+            yield '_count', values, (), cumulative
+            yield '_sum', values, (), series[-1]
+
+    def summary(self):
+        summary = {}
+        for values, series in sorted(self.values.items()):
+            count = sum(series[:-1])
+            summary[format_labels(self.labels, values)] = {
+                'count': count,
+                'sum': series[-1],
+                'mean': series[-1] / count if count else 0.0,
+                'p50': self.quantile(series, 0.5),
+                'p95': self.quantile(series, 0.95),
+            }
+        return summary
+
+    def quantile(self, series, quantile):
+        """
+        Estimate a quantile as the upper bound of the bucket holding it.
+        """
+        rank = sum(series[:-1]) * quantile
+        cumulative = 0
+        for bound, count in zip(self.buckets, series):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """
+    The registry of the counters, gauges and histograms, rendered together.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, values, extra, value in metric.samples():
+                labels = list(zip(metric.labels, values)) + list(extra)
+                label_text = ','.join(f'{label}="{escape(value)}"' for label, value in labels)
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append(f'{metric.name}{suffix}{label_text} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Get every metric that has samples as a JSON serializable dict.
+        """
+        return {metric.name: metric.summary() for metric in self.metrics if metric.values}
+
+
+def format_labels(labels, values):
+    """
+    Format a label set as "label=value,label=value", or "total" when there are no labels.
+    """
+    return ','.join(f'{label}={value}' for label, value in zip(labels, values)) or 'total'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+FETCH_REQUESTS = metrics.counter(
+    'vimm_fetch_requests_total', 'Pages fetched, by console and HTTP status', ('console', 'status'))
+FETCH_BYTES = metrics.counter(
+    'vimm_fetch_bytes_total', 'Bytes of the fetched pages', ('console',))
+FETCH_SECONDS = metrics.histogram(
+    'vimm_fetch_seconds', 'Time to fetch a page', ('console',))
+HTTP_RETRIES = metrics.counter(
+    'vimm_http_retries_total', 'Requests retried, by host and HTTP status or error', ('host', 'reason'))
+HTTP_CONCURRENCY_LIMIT = metrics.gauge(
+    'vimm_http_concurrency_limit', 'Adaptive limit of the concurrent requests to a host', ('host',))
+PAGES = metrics.counter(
+    'vimm_pages_total', 'Crawl tasks processed, by kind and outcome', ('console', 'kind', 'outcome'))
+LISTING_ROWS = metrics.counter(
+    'vimm_listing_rows_total', 'Listing rows compared with the catalog, by result',
+    ('console', 'result'))
+PAGE_SECONDS = metrics.histogram(
+    'vimm_page_seconds', 'Time to process a crawl task, from fetch to save', ('console', 'kind'))
+PARSE_SECONDS = metrics.histogram(
+    'vimm_parse_seconds', 'Time to parse a page', ('console', 'parser'))
+PARSE_PEAK_MEMORY = metrics.histogram(
+    'vimm_parse_peak_memory_bytes', 'Peak memory allocated while parsing a sampled page',
+    ('parser',), MEMORY_BUCKETS)
+DB_RECORDS = metrics.counter(
+    'vimm_db_records_total', 'Records written to the storage, by result', ('collection', 'result'))
+DB_WRITE_SECONDS = metrics.histogram(
+    'vimm_db_write_seconds', 'Time of a bulk write to the storage', ('collection',))
+DOWNLOADS = metrics.counter(
+    'vimm_downloads_total', 'Downloads finished, by outcome', ('console', 'outcome'))
+DOWNLOAD_BYTES = metrics.counter(
+    'vimm_download_bytes_total', 'Bytes downloaded', ('console',))
+DOWNLOAD_SECONDS = metrics.histogram(
+    'vimm_download_seconds', 'Time to download and verify a game', ('console',),
+    DOWNLOAD_BUCKETS)
+VERIFICATIONS = metrics.counter(
+    'vimm_verifications_total', 'Archives verified, by outcome', ('console', 'outcome'))
+VERIFY_BYTES = metrics.counter(
+    'vimm_verify_bytes_total', 'Bytes of the verified archives', ('console',))
+VERIFY_SECONDS = metrics.histogram(
+    'vimm_verify_seconds', 'Time to verify, hash and extract an archive', ('console',),
+    DOWNLOAD_BUCKETS)
+SEARCHES = metrics.counter(
+    'vimm_searches_total', 'Catalog searches, by whether the result was cached', ('cache',))
+SEARCH_SECONDS = metrics.histogram(
+    'vimm_search_seconds', 'Time to answer a catalog search', ('cache',))
+
+
+class MetricsExporter:
+    """
+    Exposes the metrics while a run is in progress.
+
+    With a `port`, the Prometheus text format is served on http://<host>:<port>/metrics.
+    With an `interval`, a JSON summary is logged every `interval` seconds, and written to
+    `summary_path` when one is given. A last summary is written when the exporter closes.
+    """
+
+    def __init__(self, registry, port=None, summary_path=None, interval=None,
+                 host='0.0.0.0'):
+        self.registry = registry
+        self.port = port
+        self.summary_path = summary_path
+        self.interval = interval
+        self.host = host
+        self.runner = None
+        self.reporter = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        if self.port:
+            app = web.Application()
+            app.router.add_get('/metrics', self.serve_metrics)
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            logger.info("Serving metrics on port %d", self.port)
+        if self.interval:
+            self.reporter = asyncio.create_task(self.report_periodically())
+
+    async def close(self):
+        if self.reporter:
+            self.reporter.cancel()
+            await asyncio.gather(self.reporter, return_exceptions=True)
+            self.reporter = None
+        if self.interval or self.summary_path:
+            self.report()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def serve_metrics(self, request):
+        return web.Response(text=self.registry.render(),
+                            content_type='text/plain', charset='utf-8')
+
+    async def report_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+    def report(self):
+        summary = self.registry.summary()
+        logger.info("Metrics: %s", json.dumps(summary))
+        if self.summary_path:
+            directory = os.path.dirname(self.summary_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.summary_path, 'w') as file:
+                json.dump(summary, file, indent=4)
@@ -0,0 +1,269 @@
+"""
+Parsers for the Vimm's Lair pages.
+
+The functions take the raw page bytes and return the records of src.records,
+so they can run in worker processes and do not depend on MongoDB.
+
+Each page is parsed into a tree holding only the elements the parser reads, and those
+elements are collected in a single walk over it. `features` selects the BeautifulSoup
+tree builder, e.g. 'html.parser' or 'lxml'.
+"""
+import base64
+import hashlib
+from bs4 import BeautifulSoup
+from bs4.filter import ElementFilter
+from src.records import GameLink, GameRecord
+
+# Elements read from a game page: key -> (tag name, attribute, value)
+GAME_PAGE_ELEMENTS = {
+    'title': ('div', 'class', 'sectionTitle'),
+    'canvas': ('canvas', None, None),
+    'download_form': ('form', 'id', 'dl_form'),
+    'table': ('table', 'class', 'rounded cellpadding1'),
+    'download_size': ('td', 'id', 'dl_size'),
+    'download_format': ('select', 'id', 'dl_format'),
+}
+
+# Elements read from a console listing page
+LISTING_PAGE_ELEMENTS = {
+    'games': ('table', 'class', 'rounded centered cellpadding1 hovertable striped'),
+}
+
+# Elements read from a console page: its listing and the navigation to its sections
+CONSOLE_PAGE_ELEMENTS = {
+    'sections': ('div', 'class', 'letters'),
+    **LISTING_PAGE_ELEMENTS,
+}
+
+# Rows of the game table that are saved, and the ones holding a score
+TABLE_FIELDS = ('Region', 'Players', 'Year', 'Graphics', 'Sound', 'Gameplay', 'Version')
+SCORE_FIELDS = ('Graphics', 'Sound', 'Gameplay')
+
+
+class PageElementsFilter(ElementFilter):
+    """
+    Only lets BeautifulSoup build the given elements (and everything inside them),
+    so the rest of the page is tokenized but never turned into a tree.
+    """
+
+    def __init__(self, elements):
+        super().__init__()
+        self.elements = elements
+
+    @property
+    def includes_everything(self):
+        return False
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return match_element(self.elements, name, attrs) is not None
+
+    def allow_string_creation(self, string):
+        return False
+
+
+def match_element(elements, name, attrs):
+    """
+    Get the key of the element a tag matches, or None.
+
+    Attribute values are matched like BeautifulSoup's find(): a single class matches any
+    of the tag's classes, several classes must match the whole class attribute.
+    """
+    for key, (element_name, attribute, value) in elements.items():
+        if name != element_name:
+            continue
+        if attribute is None:
+            return key
+        tag_value = (attrs or {}).get(attribute)
+        if tag_value is None:
+            continue
+        if isinstance(tag_value, str):
+            tag_value = tag_value.split() if attribute == 'class' else [tag_value]
+        if value in tag_value or value == ' '.join(tag_value):
+            return key
+    return None
+
+
+def find_elements(content, elements, features):
+    """
+    Parse only the given elements of the page and collect the first match of each.
+    """
+    soup = BeautifulSoup(content, features,
+                         parse_only=PageElementsFilter(elements))
+
+    found = {}
+    for tag in soup.find_all(True):
+        key = match_element(elements, tag.name, tag.attrs)
+        # The game name is in the first canvas following the section title
+        if key == 'canvas' and 'title' not in found:
+            continue
+        if key and key not in found:
+            found[key] = tag
+            if len(found) == len(elements):
+                break
+    return found
+
+
+def parse_game_page(content, features='html.parser'):
+    """
+    Extracts the game data from the given HTML content.
+    """
+    elements = find_elements(content, GAME_PAGE_ELEMENTS, features)
+
+    # Extract game name and console name
+    console = elements.get('title')
+    game_name = None
+    console_name = None
+    if console:
+        console_name = console.text.strip()
+        canvas = elements.get('canvas')
+        if canvas:
+            data_v_base64 = canvas['data-v']
+            game_name = base64.b64decode(data_v_base64).decode('utf-8')
+
+    # Verify if download is possible
+    download_form = elements.get('download_form')
+    download_possible = bool(download_form)
+    download_url = None
+    download_params = {}
+    if download_possible:
+        download_url = download_form['action']
+        # Check if download_url starts with "//" and add "https:"
+        if download_url and download_url.startswith("//"):
+            download_url = "https:" + download_url
+
+        # Extract download form parameters
+        for input_tag in download_form.find_all('input'):
+            if input_tag.has_attr('name'):
+                download_params[input_tag['name']] = input_tag.get('value', '')
+
+    # Extract table data, download size and format
+    table_data = extract_table_data(elements.get('table'))
+    download_size = extract_download_size(elements.get('download_size'))
+    download_format = extract_download_format(elements.get('download_format'))
+
+    return GameRecord(
+        Region=table_data.get('Region'),
+        Players=table_data.get('Players'),
+        Year=table_data.get('Year'),
+        Graphics=table_data.get('Graphics'),
+        Sound=table_data.get('Sound'),
+        Gameplay=table_data.get('Gameplay'),
+        Format=download_format,
+        Version=table_data.get('Version'),
+        GameName=game_name,
+        Console=console_name,
+        CanBeDownloaded=download_possible,
+        DownloadURL=download_url,
+        DownloadParams=download_params,
+        DownloadSize=download_size,
+    )
+
+
+def extract_table_data(table):
+    """
+    Extracts the game data from the game table.
+    """
+    data = {}
+    if not table:
+        return data
+
+    for row in table.find_all('tr'):
+        cols = row.find_all('td')
+        if len(cols) != 3:
+            continue
+
+        key = cols[0].text.strip()
+        if key not in TABLE_FIELDS:
+            continue
+
+        image = cols[2].find('img')
+        value = image['title'] if image else cols[2].text.strip()
+        if key == 'Version':
+            value = value.split()[0]
+        data[key] = value
+
+        if key in SCORE_FIELDS:
+            try:
+                data[key] = float(value.split()[0])
+            except ValueError:
+                pass  # TODO: Handle or log the error as necessary
+
+    return data
+
+
+def extract_download_size(size_element):
+    """
+    Extracts the download size from the dl_size cell.
+    """
+    if size_element:
+        return size_element.text.strip()
+    return None
+
+
+def extract_download_format(format_element):
+    """
+    Extracts the download format (e.g., .wbfs, .rvz) from the dl_format select.
+    """
+    if format_element:
+        selected_option = format_element.find('option', selected=True)
+        if selected_option:
+            return selected_option.text.strip()
+    return None
+
+
+def parse_game_links(content, features='html.parser'):
+    """
+    Extract the links for all games on a console listing page.
+
+    Each link comes with the signature of its listing row (name, link, region, version,
+    languages and rating), which changes when the row does.
+    """
+    game_table = find_elements(content, LISTING_PAGE_ELEMENTS, features).get('games')
+    return extract_game_links(game_table)
+
+
+def parse_console_page(content, features='html.parser'):
+    """
+    Extract the sections (letters and '#') a console's listing is split into,
+    and the links for the games listed on the console page itself.
+    """
+    elements = find_elements(content, CONSOLE_PAGE_ELEMENTS, features)
+
+    sections = []
+    navigation = elements.get('sections')
+    if navigation:
+        for link_tag in navigation.find_all('a', href=True):
+            sections.append({'name': link_tag.text.strip(), 'url': link_tag['href']})
+
+    return {'sections': sections, 'games': extract_game_links(elements.get('games'))}
+
+
+def extract_game_links(game_table):
+    """
+    Extracts the game links from the game table of a listing page.
+    """
+    game_links = []
+    if game_table:
+        rows = game_table.find_all('tr')
+        for row in rows:
+            cols = row.find_all('td')
+            if len(cols) > 1:
+                link_tag = cols[0].find('a')
+                if link_tag:
+                    game_name = link_tag.text.strip()
+                    game_url = link_tag['href']
+                    game_links.append(GameLink(game_name, game_url,
+                                               listing_signature(game_url, cols)))
+
+    return game_links
+
+
+def listing_signature(game_url, cols):
+    """
+    Hash the link and the cells of a listing row. Flags are read from their title.
+    """
+    values = [game_url]
+    for col in cols:
+        image = col.find('img')
+        values.append(image.get('title', '') if image else col.text.strip())
+    return hashlib.sha1('\x1f'.join(values).encode('utf-8')).hexdigest()
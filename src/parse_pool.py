@@ -0,0 +1,118 @@
+import asyncio
+import cProfile
+import itertools
+import logging
+import os
+import random
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from src.metrics import current_console, PARSE_PEAK_MEMORY, PARSE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def timed_parse(parser, content, features, profile_path=None, trace_memory=False):
+    """
+    Run the parser and return the record with the seconds it took and, when
+    `trace_memory` is set, the peak memory it allocated.
+
+    With a `profile_path`, the parser runs under cProfile and its stats are dumped there.
+    """
+    profiler = cProfile.Profile() if profile_path else None
+    if trace_memory:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        record = parser(content, features)
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        peak_memory = None
+        if trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return record, elapsed, peak_memory
+
+
+class ParsePool:
+    """
+    Runs the page parsers on a pool of worker processes, so parsing uses every core
+    and never blocks the fetches running on the event loop.
+
+    With `workers` set to 0 the parsers run inline, which is handy for debugging.
+    With `workers` set to None the pool has one process per core.
+    `features` is the BeautifulSoup tree builder the parsers use.
+
+    A `profile_rate` share of the pages is parsed under cProfile, with the stats written to
+    `profile_path`, and with `profile_memory` also under tracemalloc to record their peak
+    memory. Profiling slows those pages down, so they are left out of the parse times.
+    """
+
+    def __init__(self, workers=None, features='html.parser', profile_rate=0.0,
+                 profile_path=None, profile_memory=False):
+        self.features = features
+        self.executor = None
+        if workers != 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.profile_rate = profile_rate
+        self.profile_path = profile_path
+        self.profile_memory = profile_memory
+        if profile_rate and profile_path:
+            os.makedirs(profile_path, exist_ok=True)
+        self.profiles = itertools.count()
+        self.pages = 0
+        # Time parsing the pages that were not profiled
+        self.timed_pages = 0
+        self.parse_seconds = 0.0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def parse(self, parser, content):
+        """
+        Run `parser(content, features)` on the pool and return the record it extracts.
+        """
+        sampled = self.profile_rate and random.random() < self.profile_rate
+        profile_path = None
+        if sampled and self.profile_path:
+            # Numbered before the parse, so the pages parsed concurrently get their own file
+            profile_path = os.path.join(
+                self.profile_path,
+                f'{parser.__name__}-{os.getpid()}-{next(self.profiles)}.prof')
+        trace_memory = bool(sampled and self.profile_memory)
+
+        if self.executor is None:
+            record, elapsed, peak_memory = timed_parse(
+                parser, content, self.features, profile_path, trace_memory)
+        else:
+            loop = asyncio.get_running_loop()
+            record, elapsed, peak_memory = await loop.run_in_executor(
+                self.executor, timed_parse, parser, content, self.features,
+                profile_path, trace_memory)
+
+        self.pages += 1
+        if not sampled:
+            self.timed_pages += 1
+            self.parse_seconds += elapsed
+            PARSE_SECONDS.observe(elapsed, console=current_console.get(), parser=parser.__name__)
+        if peak_memory is not None:
+            PARSE_PEAK_MEMORY.observe(peak_memory, parser=parser.__name__)
+        return record
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        if self.timed_pages:
+            logger.info(
+                "Parsed %d pages with %s, %.2f ms/page.", self.pages, self.features,
+                self.parse_seconds / self.timed_pages * 1000)
@@ -0,0 +1,185 @@
+"""
+Adaptive concurrency and retries for every HTTP request of the crawl and the downloads.
+
+Each host gets an AIMD limit on its requests in flight: the limit grows by one request per
+window of healthy responses, and is cut by a factor when a request is throttled (429), fails
+with a server error, times out, or is slower than the latency target. Throttled and failed
+requests are retried with jittered exponential backoff, waiting at least as long as the
+server asks for in its Retry-After header.
+"""
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import aiohttp
+from src.metrics import HTTP_CONCURRENCY_LIMIT, HTTP_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Statuses returned by a throttled or overloaded server, worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TransientError(Exception):
+    """
+    A request failed in a way a later attempt may not.
+    """
+    retry_after = None
+
+
+class RetryableStatus(TransientError):
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"server responded with status {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+# Failures that are retried
+RETRYABLE_ERRORS = (TransientError, aiohttp.ClientConnectionError,
+                    aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+def check_status(response):
+    """
+    Raise RetryableStatus for a throttled or overloaded response, and
+    aiohttp.ClientResponseError for any other error status.
+    """
+    if response.status in RETRY_STATUSES:
+        raise RetryableStatus(
+            response.status, parse_retry_after(response.headers.get('Retry-After')))
+    response.raise_for_status()
+
+
+def parse_retry_after(retry_after):
+    """
+    Get the seconds to wait from a Retry-After header, given in seconds or as an HTTP date.
+    """
+    if not retry_after:
+        return None
+    if retry_after.strip().isdigit():
+        return float(retry_after)
+    try:
+        date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class AdaptiveLimit:
+    """
+    An AIMD limit on the requests in flight to one host, between `minimum` and `maximum`.
+    """
+
+    def __init__(self, host, initial, minimum, maximum, decrease=0.5, cooldown=1.0):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.decreased = 0.0
+        self.released = asyncio.Event()
+        HTTP_CONCURRENCY_LIMIT.set(self.limit, host=host)
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            self.released.clear()
+            await self.released.wait()
+        self.in_flight += 1
+
+    def release(self, congested):
+        """
+        Free the request's slot, growing the limit after a healthy response
+        and shrinking it after a congested one.
+        """
+        self.in_flight -= 1
+        if congested:
+            # Requests in flight when the host started struggling all fail together,
+            # only the first failure of a cooldown period counts
+            now = time.monotonic()
+            if now - self.decreased >= self.cooldown:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.decreased = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        HTTP_CONCURRENCY_LIMIT.set(self.limit, host=self.host)
+        self.released.set()
+
+
+class RateController:
+    """
+    Runs requests under the adaptive limit of their host, retrying the transient failures.
+
+    A request taking longer than `latency_target` seconds counts as congested;
+    leave it None for long transfers like the downloads.
+    """
+
+    def __init__(self, initial, minimum, maximum, attempts, backoff_base, backoff_max,
+                 latency_target=None):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.latency_target = latency_target
+        self.limits = {}
+
+    def host_limit(self, url):
+        host = urlparse(url).netloc
+        if host not in self.limits:
+            self.limits[host] = AdaptiveLimit(host, self.initial, self.minimum, self.maximum)
+        return self.limits[host]
+
+    async def call(self, url, request):
+        """
+        Await `request()`, the coroutine function making one attempt at the URL,
+        until it succeeds or runs out of attempts.
+        """
+        limit = self.host_limit(url)
+        for attempt in range(1, self.attempts + 1):
+            await limit.acquire()
+            start = time.perf_counter()
+            congested = False
+            try:
+                result = await request()
+                congested = (self.latency_target is not None
+                             and time.perf_counter() - start > self.latency_target)
+                return result
+            except RETRYABLE_ERRORS as e:
+                # Unlike an error response like a 404, these tell the host is struggling
+                congested = True
+                if attempt == self.attempts:
+                    raise
+                delay = self.backoff(attempt, getattr(e, 'retry_after', None))
+                reason = getattr(e, 'status', None) or type(e).__name__
+                HTTP_RETRIES.inc(host=limit.host, reason=reason)
+                logger.warning("Retrying %s in %.1f s (attempt %d of %d): %s",
+                               url, delay, attempt + 1, self.attempts, e)
+            finally:
+                limit.release(congested)
+            await asyncio.sleep(delay)
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Get the seconds to wait before the next attempt: a random share of an exponentially
+        growing delay, so the retries of concurrent requests don't come back together,
+        but never less than the server's Retry-After.
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+def create_rate_controller(config, maximum, latency_target=None):
+    """
+    Create the controller for requests to hosts accepting up to `maximum` concurrent requests.
+    """
+    return RateController(config.http_initial_concurrency, config.http_min_concurrency,
+                          maximum, config.http_retry_attempts, config.http_backoff_base,
+                          config.http_backoff_max, latency_target)
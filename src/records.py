@@ -0,0 +1,78 @@
+"""
+Records passed from the parsers to the bulk writers.
+
+They are slotted dataclasses, smaller than the equivalent dicts and much smaller than
+mongoengine Documents, and cheap to pickle back from the parse workers. They are turned
+into the stored documents by `to_storage` only when a batch is written.
+"""
+from dataclasses import dataclass, fields
+from typing import Optional
+
+
+@dataclass(slots=True)
+class GameRecord:
+    """
+    A game page, with the fields of GameDataDocument.
+    """
+    Region: Optional[str] = None
+    Players: Optional[str] = None
+    Year: Optional[str] = None
+    Publisher: Optional[str] = None
+    Serial: Optional[str] = None
+    Graphics: Optional[float] = None
+    Sound: Optional[float] = None
+    Gameplay: Optional[float] = None
+    Format: Optional[str] = None
+    Version: Optional[str] = None
+    GameName: Optional[str] = None
+    Console: Optional[str] = None
+    CanBeDownloaded: bool = False
+    DownloadURL: Optional[str] = None
+    DownloadParams: Optional[dict] = None
+    DownloadSize: Optional[str] = None
+    URL: Optional[str] = None
+    # Only saved when the game's listing row changed, None keeps the saved signature
+    ListingSignature: Optional[str] = None
+
+    def to_storage(self):
+        document = {name: getattr(self, name) for name in GAME_FIELDS}
+        if self.ListingSignature is None:
+            del document['ListingSignature']
+        return document
+
+
+@dataclass(slots=True)
+class ConsoleRecord:
+    """
+    A console or handheld of the vault index, with the fields of ConsoleDataDocument.
+    """
+    name: str
+    url: str
+    year: Optional[str]
+    type: str
+
+    def to_storage(self):
+        return {name: getattr(self, name) for name in CONSOLE_FIELDS}
+
+
+@dataclass(slots=True)
+class GameLink:
+    """
+    A game row of a console listing page.
+    """
+    name: str
+    url: str
+    signature: str
+
+
+GAME_FIELDS = tuple(field.name for field in fields(GameRecord))
+CONSOLE_FIELDS = tuple(field.name for field in fields(ConsoleRecord))
+
+
+def to_storage(record):
+    """
+    Get the document stored for a record. Partial updates can be given as plain dicts.
+    """
+    if isinstance(record, dict):
+        return record
+    return record.to_storage()
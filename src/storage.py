@@ -0,0 +1,639 @@
+"""
+Where the crawled consoles and games are stored.
+
+Storage is the interface the crawl, the writers and the downloader go through. MongoStorage
+keeps the catalog in MongoDB through the mongoengine documents, and only connects on first
+use. SQLiteStorage keeps it in a local SQLite file in WAL mode, for crawls on machines
+without a database server.
+
+Both store documents in the 'consoles' and 'games' collections and upsert them like
+MongoDB's $set: the fields of a document replace the saved ones, the others are kept.
+A document that is new or changed gets an UpdatedAt date, for incremental exports.
+They also hold the work queue shared by the worker processes (see src.work_queue),
+whose items are claimed atomically under a lease.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+COLLECTIONS = ('consoles', 'games')
+
+# States of a work queue item, claimed items being leased to a worker
+QUEUE_STATUSES = ('pending', 'claimed', 'done', 'failed')
+
+# SQLite caps the variables of a statement, lookups by key are split in chunks
+SQLITE_CHUNK_SIZE = 500
+
+
+@dataclass(slots=True)
+class UpsertResult:
+    new: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    errors: list = field(default_factory=list)
+
+
+class Storage(ABC):
+    """
+    The operations of the crawl and the downloader on the stored catalog.
+    They block, and are run on worker threads from the event loop. A backend implements
+    every abstract method, or fails to be created.
+    """
+
+    @abstractmethod
+    def upsert(self, collection, key, documents):
+        """
+        Upsert the documents, keyed on the `key` field, and get an UpsertResult.
+        The documents that are new or changed get the UpdatedAt date they hold, or now.
+        """
+
+    @abstractmethod
+    def get_documents(self, collection, since=None, exclude=()):
+        """
+        Get every document of the collection, or those updated since a date, one at a time.
+        The documents are dicts without their storage id and the `exclude` fields.
+        """
+
+    @abstractmethod
+    def get_listing_signatures(self, game_urls):
+        """
+        Get the listing signature saved with each of the game pages, by URL.
+        """
+
+    @abstractmethod
+    def get_downloadable_games(self, console_name):
+        """
+        Get the console's downloadable games that are not downloaded yet, one at a time,
+        as dicts holding their _id, GameName, Console, DownloadSize and DownloadParams.mediaId.
+        """
+
+    @abstractmethod
+    def has_download_state(self, console_name):
+        ...
+
+    @abstractmethod
+    def get_download_states(self, console_name):
+        """
+        Get the _id, GameName, DownloadSize and download status (None when there is none)
+        of the console's downloadable games.
+        """
+
+    @abstractmethod
+    def save_download_states(self, states):
+        """
+        Save the download state of games, given as (game _id, state dict) pairs.
+        """
+
+    @abstractmethod
+    def get_verification_states(self, console_name):
+        """
+        Get the _id, GameName, verification status and verified archive size (None when
+        it was never verified) of the console's downloadable games.
+        """
+
+    @abstractmethod
+    def save_verifications(self, verifications):
+        """
+        Save the verification of games' archives, given as (game _id, state dict) pairs.
+        """
+
+    @abstractmethod
+    def get_console_names(self):
+        ...
+
+    @abstractmethod
+    def add_work_items(self, items):
+        """
+        Add pending items to the work queue, given as dicts holding their url, kind,
+        console and options. Items whose URL is already in the queue are left as they are.
+        """
+
+    @abstractmethod
+    def claim_work_item(self, worker, kinds, lease_until):
+        """
+        Atomically claim a pending item of the kinds, or a claimed one whose lease expired,
+        for the worker until the `lease_until` timestamp. Returns the item, or None.
+        """
+
+    @abstractmethod
+    def renew_work_items(self, worker, urls, lease_until):
+        """
+        Extend the leases the worker holds on the items.
+        """
+
+    @abstractmethod
+    def finish_work_items(self, worker, done, failed, max_attempts):
+        """
+        Mark items done, and give failed items, given as (url, error) pairs, back to the
+        queue unless they were claimed `max_attempts` times already. Only the items the
+        worker still holds are changed, not those claimed by another since its lease expired.
+        """
+
+    @abstractmethod
+    def count_work_items(self, kinds):
+        """
+        Get the number of items of the kinds in each state.
+        """
+
+    @abstractmethod
+    def clear_work_items(self, kinds):
+        ...
+
+    @abstractmethod
+    def count(self, collection):
+        ...
+
+    @abstractmethod
+    def clear(self, collection):
+        ...
+
+    def close(self):
+        pass
+
+
+class MongoStorage(Storage):
+    """
+    The catalog in MongoDB, connected to on first use. `connect_options` are passed on
+    to mongoengine.connect.
+    """
+
+    def __init__(self, database_url, database='game_database', **connect_options):
+        self.database_url = database_url
+        self.database = database
+        self.connect_options = connect_options
+        self.lock = threading.Lock()
+        self.documents = None
+
+    def document(self, collection):
+        with self.lock:
+            if self.documents is None:
+                from mongoengine import connect
+                from src.console_data_extractor import ConsoleDataDocument
+                from src.game_data_extractor import GameDataDocument
+                from src.work_queue import WorkItemDocument
+
+                connect(self.database, host=self.database_url, **self.connect_options)
+                self.documents = {'consoles': ConsoleDataDocument, 'games': GameDataDocument,
+                                  'queue': WorkItemDocument}
+        return self.documents[collection]
+
+    def upsert(self, collection, key, documents):
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+
+        now = datetime.now(timezone.utc)
+        operations = []
+        for document in documents:
+            fields = {name: value for name, value in document.items() if name != 'UpdatedAt'}
+            # A pipeline update, stamping UpdatedAt only when a field differs from the
+            # saved one. Missing fields count as null, and the values are set as literals.
+            changed = {'$or': [{'$ne': [{'$ifNull': [f'${name}', None]}, {'$literal': value}]}
+                               for name, value in fields.items()]}
+            operations.append(UpdateOne({key: document[key]}, [
+                {'$set': {'UpdatedAt': {'$cond': [changed, document.get('UpdatedAt', now),
+                                                  '$UpdatedAt']}}},
+                {'$set': {name: {'$literal': value} for name, value in fields.items()}},
+            ], upsert=True))
+        try:
+            result = self.document(collection)._get_collection() \
+                .bulk_write(operations, ordered=False).bulk_api_result
+            errors = []
+        except BulkWriteError as e:
+            result = e.details
+            errors = e.details.get('writeErrors')
+        return UpsertResult(result['nUpserted'], result['nModified'],
+                            result['nMatched'] - result['nModified'], errors)
+
+    def get_documents(self, collection, since=None, exclude=()):
+        query = {'UpdatedAt': {'$gte': since}} if since else {}
+        projection = {'_id': 0, **{name: 0 for name in exclude}}
+        yield from self.document(collection)._get_collection().find(
+            query, projection, batch_size=SQLITE_CHUNK_SIZE * 10)
+
+    def get_listing_signatures(self, game_urls):
+        games = self.document('games').objects(URL__in=game_urls) \
+            .only('URL', 'ListingSignature').as_pymongo()
+        return {game['URL']: game.get('ListingSignature') for game in games}
+
+    def get_downloadable_games(self, console_name):
+        """
+        The filter runs on the server, on the (Console, CanBeDownloaded, Download.status)
+        index, and the games are read from the cursor one batch at a time.
+        """
+        return self.document('games').objects(
+            Console=console_name,
+            CanBeDownloaded=True,
+            Download__status__ne='done',
+            DownloadURL__nin=[None, ''],
+            DownloadParams__mediaId__exists=True,
+        ).only('GameName', 'Console', 'DownloadSize', 'DownloadParams.mediaId').as_pymongo()
+
+    def has_download_state(self, console_name):
+        return self.document('games').objects(
+            Console=console_name, Download__exists=True).only('id').first() is not None
+
+    def get_download_states(self, console_name):
+        games = self.document('games').objects(Console=console_name, CanBeDownloaded=True) \
+            .only('GameName', 'DownloadSize', 'Download.status').as_pymongo()
+        for game in games:
+            yield {'_id': game['_id'], 'GameName': game['GameName'],
+                   'DownloadSize': game.get('DownloadSize'),
+                   'status': (game.get('Download') or {}).get('status')}
+
+    def save_download_states(self, states):
+        from pymongo import UpdateOne
+        from src.game_data_extractor import DownloadState
+
+        # Validated by the embedded document, then saved as a single bulk write
+        operations = [UpdateOne({'_id': game_id},
+                                {'$set': {'Download': DownloadState(**state).to_mongo()}})
+                      for game_id, state in states]
+        if operations:
+            self.document('games')._get_collection().bulk_write(operations, ordered=False)
+
+    def get_verification_states(self, console_name):
+        games = self.document('games').objects(Console=console_name, CanBeDownloaded=True) \
+            .only('GameName', 'Verification.status', 'Verification.archive_size').as_pymongo()
+        for game in games:
+            verification = game.get('Verification') or {}
+            yield {'_id': game['_id'], 'GameName': game['GameName'],
+                   'status': verification.get('status'),
+                   'archive_size': verification.get('archive_size')}
+
+    def save_verifications(self, verifications):
+        from pymongo import UpdateOne
+        from src.game_data_extractor import ArchiveFile, VerificationState
+
+        operations = []
+        for game_id, state in verifications:
+            files = [ArchiveFile(**file) for file in state.get('files', ())]
+            verification = VerificationState(**{**state, 'files': files}).to_mongo()
+            operations.append(UpdateOne({'_id': game_id}, {'$set': {'Verification': verification}}))
+        if operations:
+            self.document('games')._get_collection().bulk_write(operations, ordered=False)
+
+    def get_console_names(self):
+        return self.document('consoles').objects.distinct('name')
+
+    def add_work_items(self, items):
+        from pymongo import UpdateOne
+
+        now = time.time()
+        operations = [UpdateOne({'url': item['url']}, {'$setOnInsert': {
+            **item, 'status': 'pending', 'attempts': 0, 'updated_at': now}}, upsert=True)
+            for item in items]
+        if operations:
+            self.document('queue')._get_collection().bulk_write(operations, ordered=False)
+
+    def claim_work_item(self, worker, kinds, lease_until):
+        from pymongo import ReturnDocument
+
+        now = time.time()
+        item = self.document('queue')._get_collection().find_one_and_update(
+            {'kind': {'$in': list(kinds)},
+             '$or': [{'status': 'pending'},
+                     {'status': 'claimed', 'lease_until': {'$lt': now}}]},
+            {'$set': {'status': 'claimed', 'worker': worker, 'lease_until': lease_until,
+                      'updated_at': now},
+             '$inc': {'attempts': 1}},
+            return_document=ReturnDocument.AFTER)
+        if item is None:
+            return None
+        return {field: item.get(field) for field in ('url', 'kind', 'console', 'options')}
+
+    def renew_work_items(self, worker, urls, lease_until):
+        if urls:
+            self.document('queue')._get_collection().update_many(
+                {'url': {'$in': list(urls)}, 'worker': worker, 'status': 'claimed'},
+                {'$set': {'lease_until': lease_until}})
+
+    def finish_work_items(self, worker, done, failed, max_attempts):
+        from pymongo import UpdateOne
+
+        now = time.time()
+        operations = [UpdateOne({'url': url, 'worker': worker, 'status': 'claimed'},
+                                {'$set': {'status': 'done', 'updated_at': now}})
+                      for url in done]
+        for url, error in failed:
+            # Failed items are retried until they were claimed max_attempts times
+            operations.append(UpdateOne(
+                {'url': url, 'worker': worker, 'status': 'claimed',
+                 'attempts': {'$lt': max_attempts}},
+                {'$set': {'status': 'pending', 'error': error, 'updated_at': now}}))
+            operations.append(UpdateOne(
+                {'url': url, 'worker': worker, 'status': 'claimed',
+                 'attempts': {'$gte': max_attempts}},
+                {'$set': {'status': 'failed', 'error': error, 'updated_at': now}}))
+        if operations:
+            self.document('queue')._get_collection().bulk_write(operations, ordered=True)
+
+    def count_work_items(self, kinds):
+        counts = self.document('queue')._get_collection().aggregate([
+            {'$match': {'kind': {'$in': list(kinds)}}},
+            {'$group': {'_id': '$status', 'count': {'$sum': 1}}},
+        ])
+        return {count['_id']: count['count'] for count in counts}
+
+    def clear_work_items(self, kinds):
+        self.document('queue')._get_collection().delete_many({'kind': {'$in': list(kinds)}})
+
+    def count(self, collection):
+        return self.document(collection).objects.count()
+
+    def clear(self, collection):
+        self.document(collection).drop_collection()
+
+    def close(self):
+        if self.documents is not None:
+            from mongoengine import disconnect
+
+            disconnect()
+            self.documents = None
+
+
+class SQLiteStorage(Storage):
+    """
+    The catalog in a SQLite file, one table per collection holding the documents as JSON.
+    The fields the crawl and the downloader look games up by are indexed.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        # Worker processes on the same machine may share the file, wait for their writes
+        self.connection = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # A commit in WAL mode only needs a full sync at checkpoints
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for collection in COLLECTIONS:
+            self.connection.execute(f'''
+                CREATE TABLE IF NOT EXISTS {collection} (
+                    id INTEGER PRIMARY KEY,
+                    key TEXT UNIQUE NOT NULL,
+                    document TEXT NOT NULL
+                )''')
+            self.connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {collection}_updated_at ON {collection} "
+                "(json_extract(document, '$.UpdatedAt'))")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS games_url ON games (json_extract(document, '$.URL'))")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS games_console ON games "
+            "(json_extract(document, '$.Console'), json_extract(document, '$.CanBeDownloaded'))")
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS queue (
+                url TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                console TEXT NOT NULL,
+                options TEXT NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL
+            )''')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS queue_status ON queue (status, kind)')
+        self.connection.commit()
+
+    def upsert(self, collection, key, documents):
+        result = UpsertResult()
+        keys = [dumps(document[key]) for document in documents]
+        with self.lock, self.connection:
+            saved = {}
+            for start in range(0, len(keys), SQLITE_CHUNK_SIZE):
+                chunk = keys[start:start + SQLITE_CHUNK_SIZE]
+                rows = self.connection.execute(
+                    f'SELECT key, document FROM {collection} WHERE key IN '
+                    f'({", ".join("?" * len(chunk))})', chunk)
+                saved.update((row_key, json.loads(document)) for row_key, document in rows)
+
+            now = datetime.now(timezone.utc)
+            rows = []
+            for row_key, document in zip(keys, documents):
+                updated_at = document.get('UpdatedAt', now)
+                document = {name: value for name, value in document.items()
+                            if name != 'UpdatedAt'}
+                previous = saved.get(row_key)
+                if previous is None:
+                    result.new += 1
+                else:
+                    # Round-trip the new fields through JSON so they compare like the saved ones
+                    document = {**previous, **json.loads(dumps(document))}
+                    if document == previous:
+                        result.unchanged += 1
+                        continue
+                    result.updated += 1
+                document['UpdatedAt'] = updated_at
+                rows.append((row_key, dumps(document)))
+
+            self.connection.executemany(
+                f'INSERT INTO {collection} (key, document) VALUES (?, ?) '
+                f'ON CONFLICT (key) DO UPDATE SET document = excluded.document', rows)
+        return result
+
+    def get_documents(self, collection, since=None, exclude=()):
+        query = f'SELECT document FROM {collection}'
+        parameters = ()
+        if since:
+            # Dates are saved as ISO 8601 strings in UTC, which sort like the dates
+            query += " WHERE json_extract(document, '$.UpdatedAt') >= ?"
+            parameters = (since.astimezone(timezone.utc).isoformat(),)
+        with self.lock:
+            cursor = self.connection.execute(query + ' ORDER BY id', parameters)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(SQLITE_CHUNK_SIZE)
+            if not rows:
+                return
+            for document, in rows:
+                document = json.loads(document)
+                for name in exclude:
+                    document.pop(name, None)
+                yield document
+
+    def get_listing_signatures(self, game_urls):
+        signatures = {}
+        with self.lock:
+            for start in range(0, len(game_urls), SQLITE_CHUNK_SIZE):
+                chunk = game_urls[start:start + SQLITE_CHUNK_SIZE]
+                signatures.update(self.connection.execute(
+                    "SELECT json_extract(document, '$.URL'), "
+                    "json_extract(document, '$.ListingSignature') FROM games "
+                    "WHERE json_extract(document, '$.URL') IN "
+                    f"({', '.join('?' * len(chunk))})", chunk))
+        return signatures
+
+    def get_downloadable_games(self, console_name):
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT id, json_extract(document, '$.GameName'), "
+                "json_extract(document, '$.DownloadSize'), "
+                "json_extract(document, '$.DownloadParams.mediaId') FROM games "
+                "WHERE json_extract(document, '$.Console') = ? "
+                "AND json_extract(document, '$.CanBeDownloaded') = 1 "
+                "AND COALESCE(json_extract(document, '$.Download.status'), '') != 'done' "
+                "AND COALESCE(json_extract(document, '$.DownloadURL'), '') != '' "
+                "AND json_type(document, '$.DownloadParams.mediaId') IS NOT NULL "
+                "ORDER BY id", (console_name,))
+        # Read from the cursor a chunk at a time, like the MongoDB cursor
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(SQLITE_CHUNK_SIZE)
+            if not rows:
+                return
+            for game_id, name, size, media_id in rows:
+                yield {'_id': game_id, 'GameName': name, 'Console': console_name,
+                       'DownloadSize': size, 'DownloadParams': {'mediaId': media_id}}
+
+    def has_download_state(self, console_name):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT 1 FROM games WHERE json_extract(document, '$.Console') = ? "
+                "AND json_type(document, '$.Download') IS NOT NULL LIMIT 1",
+                (console_name,)).fetchone() is not None
+
+    def get_download_states(self, console_name):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, json_extract(document, '$.GameName'), "
+                "json_extract(document, '$.DownloadSize'), "
+                "json_extract(document, '$.Download.status') FROM games "
+                "WHERE json_extract(document, '$.Console') = ? "
+                "AND json_extract(document, '$.CanBeDownloaded') = 1",
+                (console_name,)).fetchall()
+        return [{'_id': game_id, 'GameName': name, 'DownloadSize': size, 'status': status}
+                for game_id, name, size, status in rows]
+
+    def save_download_states(self, states):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE games SET document = json_set(document, '$.Download', json(?)) "
+                "WHERE id = ?", [(dumps(state), game_id) for game_id, state in states])
+
+    def get_verification_states(self, console_name):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, json_extract(document, '$.GameName'), "
+                "json_extract(document, '$.Verification.status'), "
+                "json_extract(document, '$.Verification.archive_size') FROM games "
+                "WHERE json_extract(document, '$.Console') = ? "
+                "AND json_extract(document, '$.CanBeDownloaded') = 1",
+                (console_name,)).fetchall()
+        return [{'_id': game_id, 'GameName': name, 'status': status, 'archive_size': size}
+                for game_id, name, status, size in rows]
+
+    def save_verifications(self, verifications):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE games SET document = json_set(document, '$.Verification', json(?)) "
+                "WHERE id = ?", [(dumps(state), game_id) for game_id, state in verifications])
+
+    def get_console_names(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT json_extract(document, '$.name') FROM consoles ORDER BY id")
+            return [name for name, in rows]
+
+    def add_work_items(self, items):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO queue (url, kind, console, options, status, updated_at) "
+                "VALUES (?, ?, ?, ?, 'pending', ?)",
+                [(item['url'], item['kind'], item['console'], dumps(item['options']), now)
+                 for item in items])
+
+    def claim_work_item(self, worker, kinds, lease_until):
+        now = time.time()
+        kinds = list(kinds)
+        # A single statement, so the claim is atomic between the processes sharing the file
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "UPDATE queue SET status = 'claimed', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE url = ("
+                "SELECT url FROM queue WHERE kind IN "
+                f"({', '.join('?' * len(kinds))}) "
+                "AND (status = 'pending' OR (status = 'claimed' AND lease_until < ?)) "
+                "LIMIT 1) RETURNING url, kind, console, options",
+                (worker, lease_until, now, *kinds, now)).fetchone()
+        if row is None:
+            return None
+        url, kind, console, options = row
+        return {'url': url, 'kind': kind, 'console': console, 'options': json.loads(options)}
+
+    def renew_work_items(self, worker, urls, lease_until):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE queue SET lease_until = ? "
+                "WHERE url = ? AND worker = ? AND status = 'claimed'",
+                [(lease_until, url, worker) for url in urls])
+
+    def finish_work_items(self, worker, done, failed, max_attempts):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE queue SET status = 'done', updated_at = ? "
+                "WHERE url = ? AND worker = ? AND status = 'claimed'",
+                [(now, url, worker) for url in done])
+            # Failed items are retried until they were claimed max_attempts times
+            self.connection.executemany(
+                "UPDATE queue SET status = CASE WHEN attempts < ? THEN 'pending' "
+                "ELSE 'failed' END, error = ?, updated_at = ? "
+                "WHERE url = ? AND worker = ? AND status = 'claimed'",
+                [(max_attempts, error, now, url, worker) for url, error in failed])
+
+    def count_work_items(self, kinds):
+        kinds = list(kinds)
+        with self.lock:
+            return dict(self.connection.execute(
+                "SELECT status, COUNT(*) FROM queue WHERE kind IN "
+                f"({', '.join('?' * len(kinds))}) GROUP BY status", kinds).fetchall())
+
+    def clear_work_items(self, kinds):
+        kinds = list(kinds)
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"DELETE FROM queue WHERE kind IN ({', '.join('?' * len(kinds))})", kinds)
+
+    def count(self, collection):
+        with self.lock:
+            return self.connection.execute(f'SELECT COUNT(*) FROM {collection}').fetchone()[0]
+
+    def clear(self, collection):
+        with self.lock, self.connection:
+            self.connection.execute(f'DELETE FROM {collection}')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def dumps(value):
+    """
+    Serialize a value to JSON, dates as ISO 8601 strings.
+    """
+    return json.dumps(value, default=lambda value: value.isoformat()
+                      if isinstance(value, datetime) else str(value))
+
+
+def create_storage(config):
+    """
+    Create the storage of the configured backend. Nothing is connected to until it is used.
+    """
+    if config.storage_backend == 'sqlite':
+        return SQLiteStorage(config.storage_path)
+    if config.storage_backend == 'mongo':
+        if not config.database_url:
+            raise ValueError("DATABASE_URL is required by the 'mongo' storage backend")
+        return MongoStorage(config.database_url)
+    raise ValueError(f"Unknown storage backend: {config.storage_backend!r}")
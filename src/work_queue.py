@@ -0,0 +1,201 @@
+"""
+A work queue shared by crawl and download workers running on any number of processes and hosts.
+
+Every console, listing and game page and every download is an item of the queue, stored
+in the storage and unique by URL. A worker claims one item at a time with an atomic
+find-and-modify that leases it to the worker for a while, and renews the leases of the
+items it holds with heartbeats. The items of a worker that died are claimed again once
+their lease expires. A failed item goes back to the queue until it was tried
+`max_attempts` times.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from mongoengine import Document, StringField, DictField, FloatField, IntField
+from src.crawl_scheduler import ConsoleProgress, CrawlScheduler, CrawlTask
+from src.storage import QUEUE_STATUSES
+
+logger = logging.getLogger(__name__)
+
+
+class WorkItemDocument(Document):
+    url = StringField(required=True, unique=True)
+    kind = StringField(required=True)
+    console = StringField(required=True)
+    options = DictField(required=False)
+    status = StringField(required=True, choices=QUEUE_STATUSES, default='pending')
+    worker = StringField(required=False)
+    lease_until = FloatField(required=False)
+    attempts = IntField(required=True, default=0)
+    error = StringField(required=False)
+    updated_at = FloatField(required=False)
+
+    meta = {
+        'collection': 'queue',
+        'indexes': [
+            # Items are claimed by kind, among the pending ones and the expired leases
+            ('status', 'kind', 'lease_until'),
+        ]
+    }
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class WorkQueue:
+    """
+    The shared queue, as seen by one worker claiming items of the given kinds.
+
+    It stands in for the crawl frontier of CrawlScheduler: new items are inserted before
+    the next claim, while finished items are only marked done on checkpoint(), once the
+    writers saved their records. Until then they stay leased to the worker.
+    """
+
+    def __init__(self, storage, kinds, worker_id=None, lease=60.0, heartbeat_interval=15.0,
+                 max_attempts=3, poll_interval=1.0, checkpoint_interval=5.0):
+        self.storage = storage
+        self.kinds = kinds
+        self.worker_id = worker_id or default_worker_id()
+        self.lease = lease
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.added = []
+        self.done = []
+        self.failed = []
+        # URLs of the items leased to this worker
+        self.held = set()
+
+    def reset(self):
+        """
+        Forget every item of the queue's kinds, to start a new crawl or download run.
+        """
+        self.storage.clear_work_items(self.kinds)
+
+    def add(self, task):
+        self.added.append({'url': task.url, 'kind': task.kind, 'console': task.console,
+                           'options': task.options})
+        return True
+
+    def start(self, task):
+        pass
+
+    def complete(self, task):
+        self.done.append(task.url)
+
+    def fail(self, task, error):
+        self.failed.append((task.url, str(error)))
+
+    async def claim(self):
+        """
+        Claim the next item, or get None if none is available at the moment.
+        """
+        await self.flush()
+        item = await asyncio.to_thread(
+            self.storage.claim_work_item, self.worker_id, self.kinds, time.time() + self.lease)
+        if item is None:
+            return None
+        self.held.add(item['url'])
+        return CrawlTask(item['kind'], item['url'], item['console'], item['options'] or {})
+
+    async def flush(self):
+        """
+        Insert the items added since the last flush.
+        """
+        if self.added:
+            items, self.added = self.added, []
+            await asyncio.to_thread(self.storage.add_work_items, items)
+
+    async def checkpoint(self, done=None, failed=None):
+        """
+        Mark the first `done` items completed and the first `failed` items failed, or all of
+        them, as finished in the queue.
+        """
+        await self.flush()
+        done = len(self.done) if done is None else done
+        failed = len(self.failed) if failed is None else failed
+        done, self.done = self.done[:done], self.done[done:]
+        failed, self.failed = self.failed[:failed], self.failed[failed:]
+        if done or failed:
+            await asyncio.to_thread(
+                self.storage.finish_work_items, self.worker_id, done, failed,
+                self.max_attempts)
+            self.held.difference_update(done)
+            self.held.difference_update(url for url, _ in failed)
+
+    async def renew_periodically(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if self.held:
+                await asyncio.to_thread(self.storage.renew_work_items, self.worker_id,
+                                        list(self.held), time.time() + self.lease)
+
+    @property
+    def unsaved(self):
+        return bool(self.added or self.done or self.failed)
+
+    async def finished(self):
+        """
+        Whether no worker has anything left to do: nothing of the queue's kinds is pending
+        or claimed, so no worker can add more.
+        """
+        if self.held or self.unsaved:
+            return False
+        counts = await asyncio.to_thread(self.storage.count_work_items, self.kinds)
+        return not counts.get('pending') and not counts.get('claimed')
+
+    def counts(self):
+        return self.storage.count_work_items(self.kinds)
+
+
+class QueueScheduler(CrawlScheduler):
+    """
+    Runs the tasks claimed from a WorkQueue, on `concurrency` workers like CrawlScheduler.
+
+    Tasks enqueued by the handlers go to the shared queue, where any worker process may
+    claim them. run() returns once the queue has nothing pending or claimed left.
+    """
+    shared = True
+
+    def enqueue(self, kind, url, console, **options):
+        self.frontier.add(CrawlTask(kind, url, console, options))
+
+    async def run(self):
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+        background = [asyncio.create_task(self.checkpoint_periodically()),
+                      asyncio.create_task(self.frontier.renew_periodically())]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers + background:
+                task.cancel()
+            await asyncio.gather(*workers, *background, return_exceptions=True)
+            await self.checkpoint()
+            for progress in self.progress.values():
+                super().report(progress)
+
+    async def worker(self):
+        while True:
+            task = await self.frontier.claim()
+            if task is not None:
+                self.progress.setdefault(task.console, ConsoleProgress(task.console)).pending += 1
+                await self.process(task)
+            elif self.frontier.unsaved:
+                # Save what this worker finished, so the others see the queue is done
+                try:
+                    await self.checkpoint()
+                except Exception as e:
+                    logger.error("Error saving the finished items: %s", e)
+                    await asyncio.sleep(self.frontier.poll_interval)
+            elif await self.frontier.finished():
+                return
+            else:
+                await asyncio.sleep(self.frontier.poll_interval)
+
+    def report(self, progress):
+        # More tasks of the console may still come from the queue, they are reported at the end
+        pass